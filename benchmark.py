@@ -0,0 +1,285 @@
+"""Benchmark of the message paths of Bragi, runs without a Raspberry Pi, printer or Telegram
+
+The GPIO pins are stubbed, the printer is an escpos Dummy which writes to a simulated 115200 baud
+serial port, and the handlers get synthetic updates. Every scenario reports the messages per second,
+the handler latency, the time until messages are printed and the bytes sent to the printer.
+
+Usage: python3 benchmark.py [--users 1 10 100] [--history 0 1000 10000] [--printers 1] [--messages 200] [--speedup 50]
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+from escpos.printer import Dummy
+from PIL import Image
+
+import bragi
+
+ADMIN_ID = 1
+BAUDRATE = 115200
+# Start and stop bit per byte
+BITS_PER_BYTE = 10
+# Amount of distinct images, the rest of the photos are cache hits like popular stickers
+DISTINCT_IMAGES = 8
+TEXTS = [
+    "Hello!",
+    "Greetings from the office, the coffee machine is broken again \U0001F62D",
+    "Have a look at https://github.com/ArwinV/BragiTelegramBot and tell me what you think",
+    "Ünïcödé tëxt with some ümlauts and a flag \U0001F1F3\U0001F1F1",
+    "A longer message. " * 30,
+    ]
+
+class SimulatedPort:
+    """Serial port which takes as long to write as a real one at the given baudrate"""
+
+    def __init__(self, baudrate, speedup):
+        self.seconds_per_byte = BITS_PER_BYTE / baudrate / speedup
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+        self.is_open = False
+        self.dsr = True
+        self.responses = bytearray()
+
+    def write(self, data) -> int:
+        with self.lock:
+            self.bytes_sent = self.bytes_sent + len(data)
+        # Status requests are answered with an online printer with paper
+        if data.startswith(b'\x10\x04'):
+            self.responses.append(0x12)
+        time.sleep(len(data) * self.seconds_per_byte)
+        return len(data)
+
+    def read(self, size=1) -> bytes:
+        response = bytes(self.responses[:size])
+        del self.responses[:size]
+        return response
+
+    def reset_input_buffer(self) -> None:
+        self.responses.clear()
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.is_open = False
+
+class SimulatedPrinter(Dummy):
+    """Dummy printer which sends everything to a simulated serial port"""
+
+    def __init__(self, port):
+        Dummy.__init__(self)
+        self.device = port
+
+    def open(self) -> None:
+        self.device.is_open = True
+
+    def close(self) -> None:
+        self.device.close()
+
+    def _raw(self, msg) -> None:
+        self.device.write(msg)
+
+class FakeFile:
+    def __init__(self, contents):
+        self.contents = contents
+
+    async def download_as_bytearray(self):
+        return bytearray(self.contents)
+
+class FakeBot:
+    """The parts of the Telegram bot the handlers use"""
+
+    def __init__(self, images):
+        self.images = images
+
+    async def get_file(self, file_id):
+        return FakeFile(self.images[file_id])
+
+    async def send_message(self, chat_id, text=None, **kwargs):
+        pass
+
+class FakeMessage:
+    """Synthetic incoming message, keeps track of the replies"""
+
+    def __init__(self, user_id, text=None, photo=None, caption=None):
+        self.from_user = SimpleNamespace(id=user_id, first_name="User", last_name=str(user_id))
+        self.text = text
+        self.caption = caption
+        self.photo = photo
+        self.document = None
+        self.sticker = None
+        self.sent_at = time.perf_counter()
+        self.printed_at = None
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        if text == "Printed!":
+            self.printed_at = time.perf_counter()
+
+def make_image(seed) -> bytes:
+    """A photo as it would come from Telegram, noise so it doesn't compress too well"""
+    generator = random.Random(seed)
+    image = Image.new('RGB', (1280, 960))
+    image.putdata([(x % 256, y % 256, generator.randrange(256)) for y in range(960) for x in range(1280)])
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+def percentile(values, fraction) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def setup(user_count, history, printer_count, speedup):
+    """Set up the globals of the bot with the helpers main() uses, in the current directory"""
+    bragi.setup_gpio()
+    bragi.CONFIG['user_rate_limit'] = [10 ** 9, 1]
+    bragi.CONFIG['printer_budget'] = 10 ** 9
+    with open("saves.json", 'w') as save_file:
+        json.dump({'total_prints': 0, 'text_prints': 0, 'image_prints': 0, 'users': [], 'last_user_id': 0, 'admin_id': ADMIN_ID}, save_file)
+    bragi.load_saves()
+    # Message history is imported like a messages.json of an older version
+    with open("messages.json", 'w') as save_file:
+        json.dump([{'timestamp': '2024-01-01 12:00:00', 'sender': "User {}".format(index % max(user_count, 1) + 2),
+            'text': TEXTS[index % len(TEXTS)], 'image_path': None, 'printed': True} for index in range(history)], save_file)
+    bragi.open_storage()
+    ports = []
+    connections = []
+    for index in range(printer_count):
+        # The connection checks that the device exists
+        devfile = os.path.abspath("printer{}".format(index))
+        open(devfile, 'w').close()
+        port = SimulatedPort(BAUDRATE, speedup)
+        connection = bragi.PrinterConnection(devfile)
+        connection.printer = SimulatedPrinter(port)
+        # The paper moves faster too
+        connection.throughput = bragi.ThroughputEstimator(bragi.PRINTER_INITIAL_THROUGHPUT * speedup)
+        ports.append(port)
+        connections.append(connection)
+    bragi.setup_workers(connections)
+    return ports
+
+def bytes_sent(ports) -> int:
+    return sum(port.bytes_sent for port in ports)
+
+async def run_messages(context, user_count, message_count, images):
+    """Send a burst of photos from the first user followed by a mix of messages from everyone"""
+    handler_latencies = []
+    messages = []
+    for index in range(message_count):
+        # The first user sends a burst of photos, the others mostly text
+        user_id = 2 + (0 if index < message_count // 10 else index % user_count)
+        if user_id == 2 and index % 2 == 0 or index % 5 == 0:
+            image = index % DISTINCT_IMAGES
+            photo = [SimpleNamespace(file_id="file{}".format(image), file_unique_id="unique{}".format(image))]
+            message = FakeMessage(user_id, photo=photo, caption=TEXTS[index % 2])
+            handler = bragi.get_photo_message
+        else:
+            message = FakeMessage(user_id, text=TEXTS[index % len(TEXTS)])
+            handler = bragi.get_text_message
+        start = time.perf_counter()
+        await handler(SimpleNamespace(message=message), context)
+        handler_latencies.append(time.perf_counter() - start)
+        messages.append(message)
+    return messages, handler_latencies
+
+async def wait_until_printed(tasks) -> None:
+    while bragi.print_worker.pending() > 0:
+        await asyncio.sleep(0.01)
+    await asyncio.gather(*tasks)
+
+async def run_scenario(user_count, history, printer_count, message_count, speedup, images):
+    """Run all message paths with the given amount of users and stored messages"""
+    ports = setup(user_count, history, printer_count, speedup)
+    tasks = []
+    loop = asyncio.get_running_loop()
+    context = SimpleNamespace(bot=FakeBot(images),
+        application=SimpleNamespace(create_task=lambda coroutine: tasks.append(loop.create_task(coroutine))))
+    await bragi.start_workers(None)
+    results = {}
+    try:
+        # Everyone registers, the first user is the admin
+        for user_id in [ADMIN_ID] + list(range(2, user_count + 2)):
+            await bragi.start(SimpleNamespace(message=FakeMessage(user_id, text="/start")), context)
+
+        # Immediate printing
+        bragi.printing = True
+        bytes_before = bytes_sent(ports)
+        start = time.perf_counter()
+        messages, handler_latencies = await run_messages(context, user_count, message_count, images)
+        await wait_until_printed(tasks)
+        duration = time.perf_counter() - start
+        waits = [message.printed_at - message.sent_at for message in messages if message.printed_at is not None]
+        results['immediate'] = (message_count / duration, handler_latencies, waits, bytes_sent(ports) - bytes_before)
+
+        # Queued messages, printed with /printqueue
+        bragi.printing = False
+        messages, handler_latencies = await run_messages(context, user_count, message_count, images)
+        bytes_before = bytes_sent(ports)
+        start = time.perf_counter()
+        admin_message = FakeMessage(ADMIN_ID, text="/printqueue")
+        await bragi.print_unprinted_messages_command(SimpleNamespace(message=admin_message), context)
+        await wait_until_printed(tasks)
+        duration = time.perf_counter() - start
+        results['queued'] = (message_count / duration, handler_latencies, [duration], bytes_sent(ports) - bytes_before)
+
+        # Admin commands
+        admin_latencies = []
+        for text, handler in [("/listusers", bragi.listusers_command), ("/stats", bragi.stats_command),
+                              ("/queue", bragi.queue_command), ("/givepermission 2", bragi.givepermission_command),
+                              ("/ratelimit 2 10 1", bragi.ratelimit_command), ("/emptyqueue", bragi.set_all_printed_command)]:
+            start = time.perf_counter()
+            result = handler(SimpleNamespace(message=FakeMessage(ADMIN_ID, text=text)), context)
+            if asyncio.iscoroutine(result):
+                await result
+            admin_latencies.append(time.perf_counter() - start)
+        results['admin'] = (len(admin_latencies) / sum(admin_latencies), admin_latencies, [], 0)
+    finally:
+        await bragi.stop_workers(None)
+        bragi.saves.flush()
+        bragi.message_store.close()
+    return results
+
+def report(user_count, history, printer_count, results) -> None:
+    for path, (rate, latencies, waits, bytes_sent) in results.items():
+        print("{:>6} {:>8} {:>8} {:>10} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>10}".format(
+            user_count, history, printer_count, path, rate,
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+            percentile(waits, 0.5), percentile(waits, 0.99), bytes_sent))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the message paths of Bragi without hardware")
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--history', type=int, nargs='+', default=[0, 1000, 10000])
+    parser.add_argument('--printers', type=int, nargs='+', default=[1])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--speedup', type=float, default=50, help="how much faster the simulated printer is than a real one")
+    arguments = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+    images = {"file{}".format(index): make_image(index) for index in range(DISTINCT_IMAGES)}
+    print("{:>6} {:>8} {:>8} {:>10} {:>10} {:>9} {:>9} {:>9} {:>9} {:>10}".format(
+        "users", "history", "printers", "path", "msgs/s", "p50 ms", "p99 ms", "wait p50", "wait p99", "bytes"))
+    working_directory = os.getcwd()
+    for history in arguments.history:
+        for user_count in arguments.users:
+            for printer_count in arguments.printers:
+                with tempfile.TemporaryDirectory() as directory:
+                    os.chdir(directory)
+                    try:
+                        results = asyncio.run(run_scenario(user_count, history, printer_count, arguments.messages, arguments.speedup, images))
+                    finally:
+                        os.chdir(working_directory)
+                report(user_count, history, printer_count, results)
+
+if __name__ == '__main__':
+    main()
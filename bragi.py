@@ -8,49 +8,275 @@ This bot receives messages via telegram and prints them with a receipt printer.
 
 import logging
 import sys
+import time
+# Startup is timed from here, so the time spent on imports is included
+STARTED_AT = time.perf_counter()
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext
-from escpos.printer import Serial
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, ExtBot
+from telegram.request import HTTPXRequest
 import re
-from PIL import Image
-import time
 from datetime import datetime, timedelta
 import unicodedata
-from unidecode import unidecode
+import functools
+import textwrap
 import json
+import gzip
+import io
 import os
-import RPi.GPIO as GPIO
+import sqlite3
+import struct
 import threading
+from collections import Counter, OrderedDict, deque
+import asyncio
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+# escpos, PIL and unidecode are slow to import on a Pi and aren't needed to start handling updates,
+# so they're imported where they're used
 
 # Enable logging
 logging.root.setLevel(logging.NOTSET)
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Setup GPIO for buttons
-GPIO.setwarnings(False) # Ignore warning for now
-GPIO.setmode(GPIO.BCM) # Use physical pin numbering
-GPIO.setup(4, GPIO.IN, pull_up_down=GPIO.PUD_UP) 
-GPIO.setup(24, GPIO.IN, pull_up_down=GPIO.PUD_UP) 
-GPIO.setup(25, GPIO.IN, pull_up_down=GPIO.PUD_UP) 
-# Setup gpio for LED
-GPIO.setup(18, GPIO.OUT)
-led_pwm = GPIO.PWM(18,1)
-led_pwm.start(0)
-printing = GPIO.input(25)
-
-# Url Regex
-URL_REGEX = r"""(?i)\b((?:https?:(?:/{1,3}|[a-z0-9%])|[a-z0-9.\-]+[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)/)(?:[^\s()<>{}\[\]]+|\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\))+(?:\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\)|[^\s`!()\[\]{};:\'\".,<>?«»“”‘’])|(?:(?<!@)[a-z0-9]+(?:[.\-][a-z0-9]+)*[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)\b/?(?!@)))"""
+# GPIO pins of the buttons, the immediate printing switch and the LED
+PRINTQUEUE_PIN = 4
+CLEARQUEUE_PIN = 24
+PRINT_TOGGLE_PIN = 25
+LED_PIN = 18
+# Presses of a button within this many milliseconds are seen as one
+BUTTON_BOUNCETIME = 300
+
+# Default settings, these can be overridden in config.json
+CONFIG = {
+    # Messages a user can send in a burst, and the minutes it takes to be able to send that many again
+    'user_rate_limit': [5, 5],
+    # Print budget shared by all users, to spare the paper and the print head
+    'printer_budget': 40,
+    'printer_budget_per_minute': 20,
+    'text_cost': 1,
+    'image_cost': 4,
+    # Disk space used for prepared images
+    'image_cache_megabytes': 200,
+    # Days printed messages are kept in the message store before they're archived
+    'retention_days': 7,
+    # Local HTTP endpoint with metrics in the Prometheus format, null for either disables it
+    'metrics_address': '127.0.0.1',
+    'metrics_port': 9464,
+    # Serial devices of the printers, jobs go to the printer with the least to print. When it's empty,
+    # the first of PRINTER_DEVICES which exists is used
+    'printer_devices': [],
+    # Updates handled at the same time, printing is still done one message at a time
+    'concurrent_updates': 4,
+    # Long polling: seconds Telegram keeps a request open, seconds between requests and updates per request
+    'polling_timeout': 10,
+    'polling_interval': 0.0,
+    'polling_batch_size': 100,
+    # Public https url of the webhook, polling is used when it isn't set. The webhook server listens on
+    # webhook_listen:webhook_port/webhook_path, usually behind a reverse proxy
+    'webhook_url': None,
+    'webhook_listen': '127.0.0.1',
+    'webhook_port': 8443,
+    'webhook_path': 'bragi',
+    # Sent by Telegram with every update, so updates from others are refused
+    'webhook_secret': None,
+}
+
+# Printer device, the udev rule in 99-usb-serial.rules creates /dev/receipt_printer
+PRINTER_DEVICES = ['/dev/receipt_printer', '/dev/ttyUSB1']
+# Seconds between checks of an idle printer connection, and how long to wait for reconnecting
+PRINTER_HEALTH_CHECK_INTERVAL = 30
+PRINTER_RETRY_WAIT = 10
+PRINTER_MAX_BACKOFF = 60
+
+# Messages rendered at once when printing the queue, and the size of the writes to the printer
+DRAIN_BATCH_SIZE = 20
+DRAIN_CHUNK_SIZE = 16384
+# Flow control: size of writes to the printer, the printer's input buffer, its initial
+# throughput estimate in bytes per second and how long it may stay busy before it's considered stuck
+PRINTER_CHUNK_SIZE = 1024
+PRINTER_BUFFER_BYTES = 4096
+PRINTER_INITIAL_THROUGHPUT = 8000
+PRINTER_BUSY_TIMEOUT = 30
+# Print jobs take turns per sender, these give a job a head start of this many seconds of waiting
+ADMIN_PRIORITY = 60
+SHORT_TEXT_PRIORITY = 20
+SHORT_TEXT_LENGTH = 200
+
+# Directory of the archived messages, and the seconds between archiving runs
+ARCHIVE_DIRECTORY = 'archive'
+RETENTION_INTERVAL = 3600
+
+# Width of printed images in pixels and the directory they're stored in
+IMAGE_WIDTH = 512
+IMAGE_DIRECTORY = 'images'
+# Images are stored as 1-bit rasters, which are sent to the printer in bands of this many rows.
+# White parts of at least RASTER_MIN_BLANK rows are sent as a narrow blank raster. Raster rows are always
+# one dot, so unlike feed commands this doesn't depend on the motion unit of the printer
+RASTER_EXTENSION = '.raster'
+RASTER_BAND_HEIGHT = 128
+RASTER_MIN_BLANK = 8
+# Images are decoded and resized on these threads instead of on the event loop
+image_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image")
+
+# Stages of handling a message which are timed, and the upper bounds in seconds of the histogram buckets
+METRICS_STAGES = ['download', 'decode', 'resize', 'rasterize', 'normalize', 'render', 'serial_write', 'cut']
+METRICS_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# Code pages of the printer (ESC t n) with their Python codecs, in order of preference
+PRINTER_CODE_PAGES = [(16, 'cp1252'), (18, 'cp852'), (17, 'cp866'), (0, 'cp437'), (19, 'cp858')]
+# Characters per line in the default font
+PRINTER_COLUMNS = 48
+
+# Top level domains which are recognized in urls without http:// in front of them
+URL_TLDS = frozenset("""
+    com net org edu gov mil aero asia biz cat coop info int jobs mobi museum name post pro tel
+    travel xxx ac ad ae af ag ai al am an ao aq ar as at au aw ax az ba bb bd be bf bg bh bi bj bm
+    bn bo br bs bt bv bw by bz ca cc cd cf cg ch ci ck cl cm cn co cr cs cu cv cx cy cz dd de dj dk
+    dm do dz ec ee eg eh er es et eu fi fj fk fm fo fr ga gb gd ge gf gg gh gi gl gm gn gp gq gr gs
+    gt gu gw gy hk hm hn hr ht hu id ie il im in io iq ir is it je jm jo jp ke kg kh ki km kn kp kr
+    kw ky kz la lb lc li lk lr ls lt lu lv ly ma mc md me mg mh mk ml mm mn mo mp mq mr ms mt mu mv
+    mw mx my mz na nc ne nf ng ni nl no np nr nu nz om pa pe pf pg ph pk pl pm pn pr ps pt pw py qa
+    re ro rs ru rw sa sb sc sd se sg sh si sj sk sl sm sn so sr ss st su sv sx sy sz tc td tf tg th
+    tj tk tl tm tn to tp tr tt tv tw tz ua ug uk us uy uz va vc ve vg vi vn vu wf ws ye yt yu za zm
+    zw
+""".split())
+# Candidates for urls are words starting with http(s):// or with a dot in them, which are checked against the list of top level domains
+URL_CANDIDATE_REGEX = re.compile(r"(?i)https?://[^\s<>\"'`]+|[^\s<>\"'`]*\.[^\s<>\"'`]+")
+URL_HOST_LABEL_REGEX = re.compile(r"[a-z0-9](?:[a-z0-9\-]*[a-z0-9])?")
+# Closing brackets with their opening bracket, trailing ones are kept when the url has a matching one
+URL_BRACKETS = {')': '(', ']': '[', '}': '{'}
+
+class StubGPIO:
+    """Stand-in for RPi.GPIO, used when not running on a Raspberry Pi"""
+    BCM = 'BCM'
+    IN = 'IN'
+    OUT = 'OUT'
+    PUD_UP = 'PUD_UP'
+    FALLING = 'FALLING'
+    BOTH = 'BOTH'
+
+    class PWM:
+        def __init__(self, pin, frequency):
+            self.duty_cycle = 0
+
+        def start(self, duty_cycle):
+            self.duty_cycle = duty_cycle
+
+        def ChangeDutyCycle(self, duty_cycle):
+            self.duty_cycle = duty_cycle
+
+    def __init__(self):
+        self.levels = {}
+        self.callbacks = {}
+
+    def setwarnings(self, enabled):
+        pass
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None):
+        self.levels.setdefault(pin, 1)
+
+    def input(self, pin):
+        return self.levels.get(pin, 1)
+
+    def add_event_detect(self, pin, edge, callback, bouncetime=None):
+        self.callbacks[pin] = callback
+
+    def cleanup(self):
+        pass
+
+    def trigger(self, pin, level=0):
+        """Simulate an edge on a pin, the callback runs on a separate thread like with RPi.GPIO"""
+        self.levels[pin] = level
+        thread = threading.Thread(target=self.callbacks[pin], args=(pin,))
+        thread.start()
+        thread.join()
+
+def setup_gpio() -> None:
+    """Setup the buttons and LED, falls back to a stub when not running on a Pi"""
+    global gpio, led_pwm, printing
+    try:
+        import RPi.GPIO
+        gpio = RPi.GPIO
+    except ImportError:
+        logging.warning("RPi.GPIO not available, buttons and LED are disabled")
+        gpio = StubGPIO()
+    # Setup GPIO for buttons
+    gpio.setwarnings(False) # Ignore warning for now
+    gpio.setmode(gpio.BCM) # Use physical pin numbering
+    gpio.setup(PRINTQUEUE_PIN, gpio.IN, pull_up_down=gpio.PUD_UP)
+    gpio.setup(CLEARQUEUE_PIN, gpio.IN, pull_up_down=gpio.PUD_UP)
+    gpio.setup(PRINT_TOGGLE_PIN, gpio.IN, pull_up_down=gpio.PUD_UP)
+    # Setup gpio for LED
+    gpio.setup(LED_PIN, gpio.OUT)
+    led_pwm = gpio.PWM(LED_PIN, 1)
+    led_pwm.start(0)
+    printing = gpio.input(PRINT_TOGGLE_PIN)
+
+class GpioBridge:
+    """Debounces GPIO events and hands them from the RPi.GPIO thread to the event loop"""
+
+    def __init__(self, gpio, bouncetime=BUTTON_BOUNCETIME):
+        self.gpio = gpio
+        self.bouncetime = bouncetime
+        self.loop = None
+        self.handlers = {}
+        self.last_event = {}
+        # Pending handler calls of the pins which wait until they settled
+        self.settling = {}
+
+    def add_event(self, pin, edge, handler, settle=False) -> None:
+        """Call handler(pin) on the event loop when an edge is detected. With settle the handler is called
+        once there were no edges for the bounce time, so a switch can be read with gpio.input()"""
+        self.handlers[pin] = handler
+        if settle:
+            self.settling[pin] = None
+            # Every edge is needed to know when the pin settled
+            self.gpio.add_event_detect(pin, edge, callback=self.event_detected)
+        else:
+            self.gpio.add_event_detect(pin, edge, callback=self.event_detected, bouncetime=self.bouncetime)
+
+    def event_detected(self, pin) -> None:
+        """Runs on the RPi.GPIO thread"""
+        if pin in self.settling:
+            if self.loop is None:
+                logging.warning("Bot is not running yet, ignoring GPIO event")
+                return
+            self.loop.call_soon_threadsafe(self.settle, pin)
+            return
+        now = time.monotonic()
+        # RPi.GPIO only debounces per edge, a bouncing button can still trigger both edges
+        if now - self.last_event.get(pin, float('-inf')) < self.bouncetime / 1000:
+            return
+        self.last_event[pin] = now
+        if self.loop is None:
+            logging.warning("Bot is not running yet, ignoring GPIO event")
+            return
+        self.loop.call_soon_threadsafe(self.handlers[pin], pin)
+
+    def settle(self, pin) -> None:
+        """Runs on the event loop, postpones the handler until the pin stopped bouncing"""
+        if self.settling[pin] is not None:
+            self.settling[pin].cancel()
+        self.settling[pin] = asyncio.get_running_loop().call_later(self.bouncetime / 1000, self.settled, pin)
+
+    def settled(self, pin) -> None:
+        self.settling[pin] = None
+        self.handlers[pin](pin)
 
 def printqueue_button_callback(channel):
-    print_unprinted_messages()
+    print_worker.request_drain()
 
 def clearqueue_button_callback(channel):
     set_all_printed()
 
 def print_toggle_callback(channel):
     global printing
-    printing = GPIO.input(25)
+    printing = gpio.input(PRINT_TOGGLE_PIN)
     if printing:
         logging.info("Immediate printing enabled")
     else:
@@ -62,18 +288,828 @@ def start_blinking():
 def stop_blinking():
     led_pwm.ChangeDutyCycle(0)
 
+class Histogram:
+    """Counts of durations per bucket, like a Prometheus histogram"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The last count is for durations above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds) -> None:
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count = self.count + 1
+        self.sum = self.sum + seconds
+
+    def quantile(self, fraction) -> float:
+        """Upper bound of the bucket which holds the given fraction of the durations"""
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total = total + count
+            if total >= fraction * self.count:
+                return bound
+        return float('inf')
+
+class Metrics:
+    """Durations per stage, errors per type and gauges, which can be exported in the Prometheus text format"""
+
+    def __init__(self):
+        # Stages are timed on the event loop and on the printer and image threads
+        self.lock = threading.Lock()
+        self.stages = OrderedDict((stage, Histogram(METRICS_BUCKETS)) for stage in METRICS_STAGES)
+        self.errors = Counter()
+        # Gauges are read when they're exported
+        self.gauges = OrderedDict()
+
+    def observe(self, stage, seconds) -> None:
+        with self.lock:
+            self.stages[stage].observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        """Time the body of a with statement"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count_error(self, error) -> None:
+        with self.lock:
+            self.errors[type(error).__name__] += 1
+
+    def gauge(self, name, description, read) -> None:
+        """Register a gauge, read returns its current value"""
+        self.gauges[name] = (description, read)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text format"""
+        lines = ["# HELP bragi_stage_seconds Time spent per stage of handling a message",
+                 "# TYPE bragi_stage_seconds histogram"]
+        with self.lock:
+            for stage, histogram in self.stages.items():
+                total = 0
+                for bound, count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+                    total = total + count
+                    lines.append('bragi_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage, bound, total))
+                lines.append('bragi_stage_seconds_sum{{stage="{}"}} {}'.format(stage, histogram.sum))
+                lines.append('bragi_stage_seconds_count{{stage="{}"}} {}'.format(stage, histogram.count))
+            lines.append("# HELP bragi_errors_total Failures per type of error")
+            lines.append("# TYPE bragi_errors_total counter")
+            for error, count in sorted(self.errors.items()):
+                lines.append('bragi_errors_total{{type="{}"}} {}'.format(error, count))
+        for name, (description, read) in self.gauges.items():
+            try:
+                value = read()
+            except Exception:
+                logging.exception("Reading gauge {} failed".format(name))
+                continue
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} gauge".format(name))
+            lines.append("{} {}".format(name, float(value)))
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serves the metrics on /metrics"""
+
+    def do_GET(self) -> None:
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        # Scrapes would flood the log
+        pass
+
+def start_metrics_server():
+    """Serve the metrics from a background thread, returns the server or None if it's disabled"""
+    if not CONFIG['metrics_address'] or not CONFIG['metrics_port']:
+        return None
+    try:
+        server = ThreadingHTTPServer((CONFIG['metrics_address'], CONFIG['metrics_port']), MetricsRequestHandler)
+    except OSError as e:
+        logging.warning("Unable to serve metrics on port {}: {}".format(CONFIG['metrics_port'], e))
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info("Serving metrics on http://{}:{}/metrics".format(CONFIG['metrics_address'], CONFIG['metrics_port']))
+    return server
+
+class PrinterError(Exception):
+    """Printing a job failed"""
+
+class PrinterOfflineError(PrinterError):
+    """The printer can't be reached"""
+
+class PaperOutError(PrinterError):
+    """The printer reports that the paper ran out"""
+
+class ThroughputEstimator:
+    """Learns how many bytes per second the printer actually prints"""
+
+    def __init__(self, rate, weight=0.3):
+        self.rate = rate
+        self.weight = weight
+
+    def update(self, nbytes, seconds) -> None:
+        if seconds <= 0:
+            return
+        self.rate = (1 - self.weight) * self.rate + self.weight * nbytes / seconds
+
+    def seconds(self, nbytes) -> float:
+        return nbytes / self.rate
+
+@functools.lru_cache(maxsize=None)
+def serial_errors():
+    """Exceptions raised when the serial connection fails, termios errors of a device which disappeared aren't OSErrors"""
+    import serial
+    errors = (serial.SerialException, OSError)
+    try:
+        import termios
+        errors = errors + (termios.error,)
+    except ImportError:
+        pass
+    return errors
+
+class PrinterConnection:
+    """Serial connection to the printer which stays open between jobs and is reopened when it's lost"""
+
+    def __init__(self, devfile, candidates=None):
+        self.devfile = devfile
+        # Devices the printer can show up as, the first one which exists is used when connecting
+        self.candidates = candidates
+        # Created on the first connect, so escpos isn't imported before the bot runs
+        self.printer = None
+        self.connected = False
+        # Failed connection attempts in a row, used for the backoff
+        self.failures = 0
+        self.retry_at = 0.0
+        # Flow control, the DSR line and status requests are only used if the printer supports them
+        self.throughput = ThroughputEstimator(PRINTER_INITIAL_THROUGHPUT)
+        self.dsr_supported = True
+        self.status_supported = True
+        self.sent_at = 0.0
+        self.sent_bytes = 0
+        self.paper_out = False
+        # Stats shown in /stats, updated from both the event loop and the printer thread
+        self.stats_lock = threading.Lock()
+        self.jobs_printed = 0
+        self.jobs_failed = 0
+        self.bytes_sent = 0
+        # All access to the printer happens on this single thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="printer")
+
+    def connect(self) -> None:
+        """Open the serial port, raises PrinterOfflineError when that fails"""
+        if self.candidates:
+            devfile = next((devfile for devfile in self.candidates if os.path.exists(devfile)), self.candidates[-1])
+            if devfile != self.devfile:
+                # The printer showed up on another device, like the udev symlink once it's plugged in
+                self.disconnect()
+                self.devfile = devfile
+                self.printer = None
+        try:
+            if self.printer is None:
+                from escpos.printer import Serial
+                self.printer = Serial(devfile=self.devfile,
+                                      baudrate=115200,
+                                      bytesize=8,
+                                      parity='N',
+                                      stopbits=1,
+                                      timeout=1.00,
+                                      dsrdtr=True)
+            self.printer.open()
+            # Printer settings
+            self.printer.set(align='center')
+        except Exception as e:
+            self.failures = self.failures + 1
+            backoff = min(PRINTER_MAX_BACKOFF, 2 ** self.failures)
+            self.retry_at = time.monotonic() + backoff
+            raise PrinterOfflineError("Unable to connect to printer on {}, retrying in {}s".format(self.devfile, backoff)) from e
+        self.connected = True
+        self.failures = 0
+        # An idle printer signals that it's ready, if it doesn't the DSR line probably isn't wired
+        self.dsr_supported = self.printer.device.dsr
+        logging.info("Connected to printer on {}".format(self.devfile))
+
+    def disconnect(self) -> None:
+        """Close the port, the next connect opens a new one"""
+        self.connected = False
+        if self.printer is None:
+            return
+        # escpos flushes before closing, which fails when the device is gone and then keeps the dead port.
+        # So the port is closed directly and dropped
+        device = getattr(self.printer, '_device', None)
+        try:
+            if device:
+                device.close()
+            else:
+                self.printer.close()
+        except Exception:
+            pass
+        if device:
+            self.printer._device = False
+
+    def healthy(self) -> bool:
+        """Check that the device still exists and the port is open"""
+        if not self.connected or not os.path.exists(self.devfile):
+            return False
+        device = self.printer.device
+        return device is not None and device.is_open
+
+    def ensure_connected(self, wait=0.0):
+        """Return the printer, reconnecting if needed. Waits at most wait seconds for the backoff"""
+        if self.connected:
+            if self.healthy():
+                return self.printer
+            logging.warning("Lost connection to printer on {}".format(self.devfile))
+            self.disconnect()
+        delay = self.retry_at - time.monotonic()
+        if delay > wait:
+            raise PrinterOfflineError("Printer on {} is offline, retrying in {:.0f}s".format(self.devfile, delay))
+        if delay > 0:
+            time.sleep(delay)
+        self.connect()
+        return self.printer
+
+    def read_status(self, n):
+        """Request real-time status n (DLE EOT n), returns None if the printer doesn't answer"""
+        device = self.printer.device
+        device.reset_input_buffer()
+        device.write(b'\x10\x04' + bytes([n]))
+        response = device.read(1)
+        if not response:
+            return None
+        return response[0]
+
+    def check_status(self) -> None:
+        """Raise when the printer reports that it's offline or out of paper"""
+        if not self.status_supported:
+            return
+        status = self.read_status(1)
+        if status is None:
+            logging.info("Printer on {} doesn't answer status requests".format(self.devfile))
+            self.status_supported = False
+            return
+        if status & 0x08:
+            raise PrinterOfflineError("Printer on {} is offline".format(self.devfile))
+        paper = self.read_status(4)
+        if paper is not None and paper & 0x60:
+            self.paper_out = True
+            raise PaperOutError("Printer on {} is out of paper".format(self.devfile))
+        self.paper_out = False
+
+    def wait_until_ready(self) -> float:
+        """Wait until the printer signals it can take more data (DSR), returns the time spent waiting"""
+        if not self.dsr_supported:
+            return 0.0
+        start = time.monotonic()
+        while not self.printer.device.dsr:
+            if time.monotonic() - start > PRINTER_BUSY_TIMEOUT:
+                self.check_status()
+                raise PrinterOfflineError("Printer on {} stopped accepting data".format(self.devfile))
+            time.sleep(0.01)
+        return time.monotonic() - start
+
+    def send(self, data) -> None:
+        """Write data in chunks the printer's buffer can take"""
+        start = time.monotonic()
+        write_start = time.perf_counter()
+        throttled = False
+        for position in range(0, len(data), PRINTER_CHUNK_SIZE):
+            if self.wait_until_ready() > 0:
+                throttled = True
+            self.printer._raw(bytes(data[position:position + PRINTER_CHUNK_SIZE]))
+        # Wait until everything left the serial port
+        self.printer.device.flush()
+        self.sent_at = time.monotonic()
+        self.sent_bytes = len(data)
+        self.count(nbytes=len(data))
+        metrics.observe('serial_write', time.perf_counter() - write_start)
+        # If the printer held us back it was the bottleneck, so the time it took shows how fast it prints
+        if throttled:
+            self.throughput.update(len(data), self.sent_at - start)
+
+    def count(self, printed=0, failed=0, nbytes=0) -> None:
+        """Add to the stats of this printer"""
+        with self.stats_lock:
+            self.jobs_printed = self.jobs_printed + printed
+            self.jobs_failed = self.jobs_failed + failed
+            self.bytes_sent = self.bytes_sent + nbytes
+
+    def stats(self):
+        """Return the jobs printed, jobs failed and bytes sent"""
+        with self.stats_lock:
+            return self.jobs_printed, self.jobs_failed, self.bytes_sent
+
+    def pace(self, nbytes) -> None:
+        """Wait until the printer should have printed the last nbytes that were sent"""
+        backlog = min(nbytes, PRINTER_BUFFER_BYTES)
+        wait = self.throughput.seconds(backlog) - (time.monotonic() - self.sent_at)
+        if wait > 0:
+            time.sleep(wait)
+        self.check_status()
+
+    def backlog(self) -> float:
+        """Seconds until the printer should have printed everything that was sent"""
+        return max(0.0, self.throughput.seconds(min(self.sent_bytes, PRINTER_BUFFER_BYTES)) - (time.monotonic() - self.sent_at))
+
+    def available(self) -> bool:
+        """Whether the printer can take jobs, it can't while it's out of paper or waiting to reconnect"""
+        return not self.paper_out and (self.connected or time.monotonic() >= self.retry_at)
+
+    def check(self) -> None:
+        """Periodic health check, reconnects when the connection was lost and sees if paper was added"""
+        try:
+            self.ensure_connected()
+            if self.paper_out:
+                self.check_status()
+        except PrinterError as e:
+            metrics.count_error(e)
+            logging.warning(e)
+
+    def run(self, job, attempts=3) -> None:
+        """Run job(printer), reconnecting and retrying when the connection fails"""
+        for attempt in range(attempts):
+            try:
+                printer = self.ensure_connected(wait=PRINTER_RETRY_WAIT)
+            except PrinterOfflineError as e:
+                metrics.count_error(e)
+                error = e
+                continue
+            try:
+                self.check_status()
+                job(printer)
+                return
+            except serial_errors() as e:
+                metrics.count_error(e)
+                logging.warning("Printing failed on {}: {}".format(self.devfile, e))
+                self.disconnect()
+                error = e
+        # Give other printers the next jobs for a while
+        self.retry_at = max(self.retry_at, time.monotonic() + PRINTER_RETRY_WAIT)
+        if isinstance(error, PrinterOfflineError):
+            raise error
+        raise PrinterError("Printing failed after {} attempts".format(attempts)) from error
+
+def message_sender(message):
+    """Key the scheduler uses for the sender of a message, messages of older versions only have a name"""
+    return message.get('sender_id', message['sender'])
+
+def message_priority(message) -> int:
+    """Head start of a message in the queue, admin messages and short texts go first"""
+    priority = 0
+    if user_is_admin(message.get('sender_id')):
+        priority = priority + ADMIN_PRIORITY
+    if message['image_path'] == None and len(message['text']) <= SHORT_TEXT_LENGTH:
+        priority = priority + SHORT_TEXT_PRIORITY
+    return priority
+
+def fair_order(messages):
+    """Order messages so the senders take turns, with the admin and short texts first in every turn"""
+    queues = OrderedDict()
+    for message in messages:
+        queues.setdefault(message_sender(message), deque()).append(message)
+    ordered = []
+    while queues:
+        turn = [queue.popleft() for queue in queues.values()]
+        ordered.extend(sorted(turn, key=message_priority, reverse=True))
+        queues = OrderedDict((sender, queue) for sender, queue in queues.items() if queue)
+    return ordered
+
+class FairScheduler:
+    """Picks the next print job, so one sender with a lot of messages can't hold up everyone else"""
+
+    def __init__(self):
+        # Jobs of every sender in the order they were submitted
+        self.queues = OrderedDict()
+        self.served_at = {}
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def push(self, sender, priority, job, front=False) -> None:
+        """Queue a job, at the front of the sender's jobs when it's retried"""
+        queue = self.queues.setdefault(sender, deque())
+        if front:
+            queue.appendleft((time.monotonic(), priority, job))
+        else:
+            queue.append((time.monotonic(), priority, job))
+
+    def score(self, sender, now) -> float:
+        """Seconds the sender has been waiting plus the head start of its next job"""
+        queued_at, priority, job = self.queues[sender][0]
+        # A sender only starts waiting again once its previous job went to the printer, so senders take turns.
+        # Waiting grows without limit, so a job without priority is never held up forever
+        waiting = now - max(queued_at, self.served_at.get(sender, queued_at))
+        return waiting + priority
+
+    def pop(self):
+        """Remove and return the next job"""
+        now = time.monotonic()
+        sender = max(self.queues, key=lambda sender: self.score(sender, now))
+        queue = self.queues[sender]
+        queued_at, priority, job = queue.popleft()
+        if queue:
+            self.served_at[sender] = now
+        else:
+            del self.queues[sender]
+            self.served_at.pop(sender, None)
+        return job
+
+    def depths(self):
+        """Amount of waiting jobs per sender"""
+        return {sender: len(queue) for sender, queue in self.queues.items()}
+
+class PrintWorker:
+    """Hands print jobs to a pool of printers, every printer takes the next job once it's free"""
+
+    def __init__(self, connections):
+        self.connections = connections
+        self.loop = None
+        self.scheduler = FairScheduler()
+        self.wakeup = None
+        self.tasks = []
+        # Printers which are handling a job
+        self.busy = set()
+        self.pending_drain = None
+
+    async def start(self) -> None:
+        """Start consuming jobs, has to be called from the running event loop"""
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.tasks = [self.loop.create_task(self.run(connection)) for connection in self.connections]
+
+    async def stop(self) -> None:
+        """Finish the queued jobs and stop the worker"""
+        if not self.tasks:
+            return
+        while self.pending() > 0:
+            await asyncio.sleep(0.1)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for connection in self.connections:
+            connection.executor.shutdown(wait=True)
+
+    def pending(self) -> int:
+        """Amount of jobs waiting for or being handled by a printer"""
+        return len(self.scheduler) + len(self.busy)
+
+    def submit(self, function, *args, sender=None, priority=0) -> asyncio.Future:
+        """Queue a print job, function(connection, *args) is called on the thread of a printer.
+        The returned future resolves to the result of the job"""
+        future = self.loop.create_future()
+        self.scheduler.push(sender, priority, (function, args, future, sender, priority))
+        self.wakeup.set()
+        return future
+
+    def request_drain(self) -> asyncio.Future:
+        """Print all unprinted messages, unless that's already about to start"""
+        if self.pending_drain is None:
+            self.pending_drain = self.loop.create_task(self.drain())
+        return self.pending_drain
+
+    async def drain(self) -> None:
+        """Print all unprinted messages, the batches are spread over the printers"""
+        # Requests from now on need a new drain, this one might miss their messages
+        self.pending_drain = None
+        logging.info("Printing all unprinted messages")
+        # Senders take turns, so one sender with a lot of messages doesn't hold up the rest
+        pending = fair_order(message_store.unprinted())
+        jobs = [self.submit(print_batch, pending[start:start + DRAIN_BATCH_SIZE], priority=ADMIN_PRIORITY)
+                for start in range(0, len(pending), DRAIN_BATCH_SIZE)]
+        await asyncio.gather(*jobs)
+        logging.info("Printed {} messages".format(len(pending)))
+
+    def next_job(self, connection):
+        """Return the next job if this printer should take it, which is the idle printer with the least to print"""
+        if len(self.scheduler) == 0 or connection in self.busy:
+            return None
+        idle = [other for other in self.connections if other not in self.busy]
+        # When no printer is available at all, jobs fail like they would with a single printer
+        if any(other.available() for other in self.connections):
+            idle = [other for other in idle if other.available()]
+        if not idle or min(idle, key=lambda other: other.backlog()) is not connection:
+            return None
+        job = self.scheduler.pop()
+        # Let the other printers have a look at the rest
+        if len(self.scheduler) > 0:
+            self.wakeup.set()
+        return job
+
+    async def run(self, connection) -> None:
+        """Hand jobs to the thread of a printer and report back through their futures"""
+        while True:
+            job = self.next_job(connection)
+            if job is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=PRINTER_HEALTH_CHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    # Check the printer connection while idle
+                    await self.loop.run_in_executor(connection.executor, connection.check)
+                continue
+            function, args, future, sender, priority = job
+            self.busy.add(connection)
+            try:
+                result = await self.loop.run_in_executor(connection.executor, function, connection, *args)
+            except Exception as e:
+                metrics.count_error(e)
+                connection.count(failed=1)
+                if isinstance(e, PrinterError) and any(other.available() for other in self.connections if other is not connection):
+                    # Move the job to another printer, messages which were printed already are skipped
+                    logging.warning("Printer on {} failed, moving its job to another printer: {}".format(connection.devfile, e))
+                    self.scheduler.push(sender, priority, job, front=True)
+                else:
+                    logging.exception("Print job failed")
+                    if not future.cancelled():
+                        future.set_exception(e)
+            else:
+                connection.count(printed=1)
+                if not future.cancelled():
+                    future.set_result(result)
+            finally:
+                self.busy.discard(connection)
+                # Another printer might be waiting for this one to finish
+                self.wakeup.set()
+
+class MessageStore:
+    """Append-only message storage in SQLite with an index on the unprinted messages"""
+
+    def __init__(self, path):
+        # The store is used from both the event loop and the printer thread
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            printed INTEGER NOT NULL DEFAULT 0,
+            message TEXT NOT NULL)""")
+        # Partial index, so looking up the queue only touches unprinted messages
+        self.connection.execute("CREATE INDEX IF NOT EXISTS unprinted_messages ON messages (id) WHERE printed = 0")
+
+    @staticmethod
+    def encode(message) -> str:
+        return json.dumps({key: value for key, value in message.items() if key not in ('id', 'printed')})
+
+    def add(self, message) -> None:
+        """Append a message, its id is stored in the message"""
+        with self.lock:
+            cursor = self.connection.execute("INSERT INTO messages (printed, message) VALUES (?, ?)",
+                (int(message['printed']), self.encode(message)))
+        message['id'] = cursor.lastrowid
+
+    def mark_printed(self, message) -> None:
+        """Mark a single message as printed"""
+        with self.lock:
+            self.connection.execute("UPDATE messages SET printed = 1 WHERE id = ?", (message['id'],))
+        message['printed'] = True
+
+    def mark_all_printed(self) -> int:
+        """Mark all unprinted messages as printed, returns the amount of messages"""
+        with self.lock:
+            cursor = self.connection.execute("UPDATE messages SET printed = 1 WHERE printed = 0")
+        return cursor.rowcount
+
+    def unprinted(self):
+        """Return the unprinted messages, oldest first"""
+        with self.lock:
+            rows = self.connection.execute("SELECT id, message FROM messages WHERE printed = 0 ORDER BY id").fetchall()
+        messages = []
+        for message_id, body in rows:
+            message = json.loads(body)
+            message['id'] = message_id
+            message['printed'] = False
+            messages.append(message)
+        return messages
+
+    def printed_before(self, timestamp, limit=500):
+        """Printed messages received before timestamp, oldest first"""
+        with self.lock:
+            rows = self.connection.execute("SELECT id, message FROM messages WHERE printed = 1 ORDER BY id LIMIT ?", (limit,)).fetchall()
+        messages = []
+        for message_id, body in rows:
+            message = json.loads(body)
+            # Messages are stored in the order they're received, so the rest is newer
+            if message['timestamp'] >= timestamp:
+                break
+            message['id'] = message_id
+            message['printed'] = True
+            messages.append(message)
+        return messages
+
+    def delete(self, messages) -> None:
+        with self.lock:
+            self.connection.executemany("DELETE FROM messages WHERE id = ?", [(message['id'],) for message in messages])
+
+    def unprinted_image_paths(self):
+        """Paths of the images which still have to be printed"""
+        return {message['image_path'] for message in self.unprinted() if message['image_path'] != None}
+
+    def is_printed(self, message) -> bool:
+        with self.lock:
+            row = self.connection.execute("SELECT printed FROM messages WHERE id = ?", (message['id'],)).fetchone()
+        # Messages which were archived were printed
+        return row is None or row[0] == 1
+
+    def count_unprinted(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM messages WHERE printed = 0").fetchone()[0]
+
+    def import_json(self, path) -> None:
+        """One-time import of a messages.json file from older versions of the bot"""
+        if not os.path.exists(path):
+            return
+        with open(path) as save_file:
+            messages = json.load(save_file)
+        # Older versions stored captions as a list with one item
+        for message in messages:
+            if isinstance(message['text'], list):
+                message['text'] = message['text'][0]
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany("INSERT INTO messages (printed, message) VALUES (?, ?)",
+                    [(int(message['printed']), self.encode(message)) for message in messages])
+            except:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+        # Move the file out of the way so it is only imported once
+        os.replace(path, path + '.imported')
+        logging.info("Imported {} messages from {}".format(len(messages), path))
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+async def start_workers(application: Application) -> None:
+    global retention_task, printer_tasks
+    await print_worker.start()
+    gpio_bridge.loop = asyncio.get_running_loop()
+    retention_task = asyncio.get_running_loop().create_task(retention_loop())
+    # Updates are handled while the printers come up
+    printer_tasks = [asyncio.get_running_loop().create_task(bring_up_printer(connection)) for connection in printers]
+    logging.info("Startup: handling updates after {:.2f}s".format(time.perf_counter() - STARTED_AT))
+
+async def stop_workers(application: Application) -> None:
+    gpio_bridge.loop = None
+    retention_task.cancel()
+    for task in printer_tasks:
+        task.cancel()
+    await print_worker.stop()
+    # Write the remaining changes while the loop still runs
+    write = saves.flush()
+    if write is not None:
+        await asyncio.wrap_future(write)
+
+async def bring_up_printer(connection) -> None:
+    """Connect to a printer and print the started message, retrying until the printer is available"""
+    while True:
+        try:
+            # On the printer's thread, like all other access to the printer
+            await asyncio.get_running_loop().run_in_executor(connection.executor, connection.run, render_started_message)
+        except PrinterError as e:
+            logging.warning("Printer not available yet: {}".format(e))
+            await asyncio.sleep(PRINTER_RETRY_WAIT)
+            continue
+        logging.info("Startup: printer on {} ready after {:.2f}s".format(connection.devfile, time.perf_counter() - STARTED_AT))
+        return
+
+async def retention_loop() -> None:
+    """Regularly archive old messages"""
+    while True:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, archive_old_messages)
+        except Exception as e:
+            metrics.count_error(e)
+            logging.exception("Archiving old messages failed")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+def archive_old_messages() -> None:
+    """Move printed messages older than the retention window to compressed archives, and remove their images"""
+    cutoff = datetime.now() - timedelta(days=CONFIG['retention_days'])
+    archived = 0
+    while True:
+        messages = message_store.printed_before(cutoff.strftime('%Y-%m-%d %H:%M:%S'))
+        if not messages:
+            break
+        # One archive per day, gzip allows appending to an existing file
+        segment = os.path.join(ARCHIVE_DIRECTORY, "messages-{}.jsonl.gz".format(datetime.now().strftime('%Y-%m-%d')))
+        with gzip.open(segment, 'at') as archive_file:
+            for message in messages:
+                archive_file.write(json.dumps(message) + "\n")
+        message_store.delete(messages)
+        # Images stored by older versions of the bot aren't in the image cache
+        for message in messages:
+            path = message['image_path']
+            if path != None and os.path.dirname(path) != IMAGE_DIRECTORY and os.path.exists(path):
+                os.remove(path)
+        archived = archived + len(messages)
+    # Images in the cache are shared by messages, so they're removed once they haven't been used for a while
+    image_cache.remove_unused(cutoff.timestamp())
+    if archived > 0:
+        logging.info("Archived {} messages".format(archived))
+
+async def reply_when_printed(update: Update, context: CallbackContext, name, job: asyncio.Future) -> None:
+    """Wait for a print job to finish and tell the sender how it went"""
+    try:
+        printed = await job
+    except Exception:
+        printed = False
+    if printed:
+        await update.message.reply_text("Printed!")
+    else:
+        await error_printing(update, context, name)
+
+async def queue_print_job(update: Update, context: CallbackContext, name, message) -> None:
+    """Hand a message to the print worker without waiting for the printer"""
+    if print_worker.pending() > 0:
+        await update.message.reply_text("Message queued, it will be printed in a moment!")
+    job = print_worker.submit(print_message, message, sender=message_sender(message), priority=message_priority(message))
+    # Reply from a separate task so the handler doesn't hold up other updates
+    context.application.create_task(reply_when_printed(update, context, name, job))
+
 async def error_printing(update: Update, context: CallbackContext, name) -> None:
     logging.error("Failed to print message")
     await update.message.reply_text("Failed to print your message :( There appears to be something wrong...")
     await context.bot.send_message(data['admin_id'], text="Failed to print a text message from {}.".format(name))
 
+class SaveFile:
+    """Write-behind storage of a json file, changes are flushed in batches.
+    Changes are registered on the event loop, only writing the file happens on another thread"""
+
+    def __init__(self, path, serialize, delay=10.0, max_changes=25):
+        self.path = path
+        self.serialize = serialize
+        self.delay = delay
+        self.max_changes = max_changes
+        self.changes = 0
+        self.timer = None
+        # A single thread, so the writes happen in order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="saves")
+
+    def mark_dirty(self) -> None:
+        """Register a change, which is written after a delay or once enough changes piled up.
+        Has to be called from the event loop"""
+        self.changes = self.changes + 1
+        if self.changes >= self.max_changes:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.delay, self.flush)
+
+    def flush(self):
+        """Write pending changes, returns the future of the write or None if nothing changed.
+        On the event loop the write happens in the background, otherwise it waits for the write"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.changes == 0:
+            return None
+        # Serialized here, so nothing changes the data halfway through
+        contents = json.dumps(self.serialize())
+        self.changes = 0
+        future = self.executor.submit(self.write, contents)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Not on the event loop, like at shutdown
+            future.result()
+            return future
+        future.add_done_callback(self.log_failure)
+        return future
+
+    def log_failure(self, future) -> None:
+        if future.exception() is not None:
+            logging.error("Unable to write {}: {}".format(self.path, future.exception()))
+
+    def write(self, contents) -> None:
+        """Atomically replace the file, so a crash never leaves a half written file"""
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as save_file:
+            save_file.write(contents)
+            save_file.flush()
+            os.fsync(save_file.fileno())
+        os.replace(temp_path, self.path)
+
 def store_data() -> None:
-    """Store data to json file"""
-    with open('saves.json', 'w') as save_file:
-        json.dump(data, save_file)
+    """Mark data as changed, it is written to the json file in the background"""
+    saves.mark_dirty()
 
 def update_stats(printed_type) -> None:
-    """Increment stats"""
+    """Increment stats, has to be called from the event loop"""
     data['total_prints'] = data['total_prints'] + 1
     if printed_type == 'text':
         data['text_prints'] = data['text_prints'] + 1
@@ -88,75 +1124,189 @@ def user_is_admin(user_id) -> bool:
     else:
         return False
 
-def user_info(telegram_user):
-    """Return username and permission to print"""
-    for user in data['users']:
-        if user['id'] == telegram_user.id:
-            # If username is changed, update the settings
-            if "{} {}".format(telegram_user.first_name, telegram_user.last_name) != user['name']:
-                user['name'] = "{} {}".format(telegram_user.first_name, telegram_user.last_name)
-                store_data()
-            # Return username and permission to print
-            if user['anonymous']:
-                return "Anonymous", user['permission_to_print']
-            else:
-                return user['name'], user['permission_to_print']
-    else:
-        return "Unknown", False
-
-def user_exists(telegram_user):
-    """Check if user exists"""
-    for user in data['users']:
-        if user['id'] == telegram_user.id:
-            return True
-    else:
+def valid_rate_limit(rate_limit) -> bool:
+    """Check that a [messages, minutes] rate limit allows at least one message in a positive amount of time"""
+    try:
+        messages, minutes = rate_limit
+        return messages >= 1 and minutes > 0
+    except (TypeError, ValueError):
         return False
 
-def has_permission_to_print(telegram_user):
-    """ Returns whether the user has permission to print"""
-    for user in data['users']:
-        if user['id'] == telegram_user.id:
-            return user['permission_to_print']
-    else:
-        return False
+class User:
+    """A registered user, stored in the users list of saves.json"""
+    __slots__ = ('id', 'name', 'permission_to_print', 'anonymous', 'rate_limit')
 
-def is_spamming(telegram_user):
-    """Returns if user is spamming"""
-    if user_is_admin(telegram_user.id):
-        return False
-    for user in data['users']:
-        if user['id'] == telegram_user.id:
-            if (datetime.now() - datetime.fromisoformat(user['last_message'])) < timedelta(minutes=5):
-                if user['recent_messages'] >= 5:
-                    return True
-                else:
-                    user['last_message'] = datetime.now().isoformat()
-                    user['recent_messages'] = user['recent_messages'] + 1
-                    return False
-            else:
-                user['last_message'] = datetime.now().isoformat()
-                user['recent_messages'] = 0
-                return False
-    else:
+    def __init__(self, id, name, permission_to_print=True, anonymous=False, rate_limit=None):
+        self.id = id
+        self.name = name
+        self.permission_to_print = permission_to_print
+        self.anonymous = anonymous
+        # [messages, minutes] for this user, None uses the default from the config
+        self.rate_limit = rate_limit
+
+    @classmethod
+    def from_dict(cls, user):
+        user = cls(**{key: user[key] for key in cls.__slots__ if key in user})
+        # Older versions accepted limits which can't be used
+        if user.rate_limit is not None and not valid_rate_limit(user.rate_limit):
+            logging.warning("Ignoring invalid rate limit {} of {}".format(user.rate_limit, user.name))
+            user.rate_limit = None
+        return user
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    @property
+    def display_name(self) -> str:
+        """Name printed above messages of this user"""
+        if self.anonymous:
+            return "Anonymous"
+        else:
+            return self.name
+
+    def update_name(self, telegram_user) -> bool:
+        """Update the name if it was changed on Telegram, returns whether it changed"""
+        name = "{} {}".format(telegram_user.first_name, telegram_user.last_name)
+        if name == self.name:
+            return False
+        self.name = name
         return True
 
+class UserRegistry:
+    """All registered users, keyed by their Telegram user id"""
+
+    def __init__(self, users=()):
+        self.users = {}
+        for user in users:
+            self.add(User.from_dict(user))
+
+    def get(self, user_id):
+        """Return the user with the given id, or None when it isn't registered"""
+        return self.users.get(int(user_id))
+
+    def add(self, user) -> None:
+        self.users[user.id] = user
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self.users
+
+    def __iter__(self):
+        return iter(self.users.values())
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def to_list(self):
+        """Users in the format of saves.json"""
+        return [user.to_dict() for user in self.users.values()]
+
+class TokenBucket:
+    """Token bucket on the monotonic clock, so changes of the system time don't matter"""
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated')
+
+    def __init__(self, capacity, rate, tokens=None):
+        self.capacity = capacity
+        # Tokens per second
+        self.rate = rate
+        self.tokens = capacity if tokens is None else min(tokens, capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+class RateLimiter:
+    """Limits the messages per user and the total amount of printing"""
+
+    def __init__(self):
+        self.buckets = {}
+        self.printer = TokenBucket(CONFIG['printer_budget'], CONFIG['printer_budget_per_minute'] / 60)
+
+    def bucket(self, user) -> TokenBucket:
+        """Return the bucket of a user, taking changed limits into account"""
+        messages, minutes = user.rate_limit or CONFIG['user_rate_limit']
+        bucket = self.buckets.get(user.id)
+        if bucket is None:
+            bucket = self.buckets[user.id] = TokenBucket(messages, messages / (minutes * 60))
+        else:
+            bucket.capacity = messages
+            bucket.rate = messages / (minutes * 60)
+        return bucket
+
+    def allow(self, user, cost):
+        """Take a message from the user and the cost from the printer budget, returns the limit that was hit or None"""
+        if user_is_admin(user.id):
+            return None
+        now = time.monotonic()
+        bucket = self.bucket(user)
+        bucket.refill(now)
+        self.printer.refill(now)
+        if bucket.tokens < 1:
+            return 'user'
+        if self.printer.tokens < cost:
+            return 'printer'
+        bucket.tokens = bucket.tokens - 1
+        self.printer.tokens = self.printer.tokens - cost
+        return None
+
+    def snapshot(self):
+        """State of the buckets for saves.json, full buckets are left out"""
+        now = time.monotonic()
+        user_tokens = {}
+        for user_id, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens < bucket.capacity:
+                user_tokens[str(user_id)] = round(bucket.tokens, 3)
+        self.printer.refill(now)
+        return {'saved_at': time.time(), 'users': user_tokens, 'printer': round(self.printer.tokens, 3)}
+
+    def restore(self, snapshot) -> None:
+        """Restore buckets from a snapshot, adding the tokens regained while the bot was offline"""
+        if not snapshot:
+            return
+        offline = max(0.0, time.time() - snapshot['saved_at'])
+        for user_id, tokens in snapshot['users'].items():
+            user = users.get(user_id)
+            if user is not None:
+                bucket = self.bucket(user)
+                bucket.tokens = min(bucket.capacity, tokens + offline * bucket.rate)
+        self.printer.tokens = min(self.printer.capacity, snapshot['printer'] + offline * self.printer.rate)
+
+async def authorize(update: Update, cost):
+    """Resolve the sender and check whether they may print, returns None (after replying) if not"""
+    user = users.get(update.message.from_user.id)
+    # Check if user exists
+    if user is None:
+        await update.message.reply_text("Please use the /start command before sending anything.")
+        return None
+    # If username is changed, update the settings
+    if user.update_name(update.message.from_user):
+        store_data()
+    # Check permission to print
+    if not user.permission_to_print:
+        await update.message.reply_text("You do not have permission to print anymore.")
+        return None
+    # Check if user is spamming or the printer has been printing too much, only messages which are stored cost tokens
+    limit = rate_limiter.allow(user, cost)
+    if limit == 'user':
+        await update.message.reply_text("Please wait a few minutes before sending another message.")
+        return None
+    elif limit == 'printer':
+        await update.message.reply_text("The printer is very busy right now, please try again in a minute.")
+        return None
+    return user
+
 async def start(update: Update, context: CallbackContext) -> None:
     """Start the bot for a user"""
     await update.message.reply_text("Hi! This is Bragi the receipt printer. The printer will print all text messages or photos that are sent to it. The bot is named after the skaldic god of poetry in Norse mythology. Type /help for more info.")
     #await help_command(update, context)
     # Add user to list of users
-    for user in data['users']:
-        if user['id'] == update.message.from_user.id:
-            await update.message.reply_text("You are already registered")
-            break
+    if update.message.from_user.id in users:
+        await update.message.reply_text("You are already registered")
     else:
-        data['users'].append({
-            'name': "{} {}".format(update.message.from_user.first_name, update.message.from_user.last_name),
-            'id': update.message.from_user.id,
-            'permission_to_print': True, # Default permission to print, used to block people if they're annoying
-            'anonymous': False,
-            'last_message': datetime(1970, 1, 1).isoformat(),
-            'recent_messages': 0})
+        # Users get permission to print by default, it's used to block people if they're annoying
+        users.add(User(update.message.from_user.id,
+            "{} {}".format(update.message.from_user.first_name, update.message.from_user.last_name)))
         data['last_user_id'] = update.message.from_user.id
         store_data()
     await context.bot.send_message(data['admin_id'], text="{} {} Started the bot.".format(update.message.from_user.first_name, update.message.from_user.last_name, update.message.from_user.id))
@@ -167,8 +1317,8 @@ async def listusers_command(update: Update, context: CallbackContext) -> None:
         await update.message.reply_text("You are not allowed to use this command")
         return
     reply_text = "Name | User ID | Permission to print\n"
-    for user in data['users']:
-        reply_text += "{} | {} | {}\n".format(user['name'], user['id'], user['permission_to_print'])
+    for user in users:
+        reply_text += "{} | {} | {}\n".format(user.name, user.id, user.permission_to_print)
     await update.message.reply_text(reply_text)
 
 async def givepermission_command(update: Update, context: CallbackContext) -> None:
@@ -182,16 +1332,13 @@ async def givepermission_command(update: Update, context: CallbackContext) -> No
         user_id = data['last_user_id']
     else:
         user_id = arguments[1]
-    # Loop through users
-    for user in data['users']:
-        if user['id'] == int(user_id):
-            user['permission_to_print'] = True
-            username = user['name']
-            await context.bot.send_message(user['id'], "You now have permission to print :D")
-            break;
-    else:
+    user = users.get(user_id)
+    if user is None:
         await update.message.reply_text("User id not found")
         return
+    user.permission_to_print = True
+    username = user.name
+    await context.bot.send_message(user.id, "You now have permission to print :D")
     store_data()
     await update.message.reply_text("Permission to print of {} set to True".format(username))
 
@@ -206,23 +1353,54 @@ async def removepermission_command(update: Update, context: CallbackContext) ->
         user_id = data['last_user_id']
     else:
         user_id = arguments[1]
-    for user in data['users']:
-        if user['id'] == int(user_id):
-            user['permission_to_print'] = False
-            username = user['name']
-            await context.bot.send_message(user['id'], "You no longer have permission to print...")
-            break;
-    else:
+    user = users.get(user_id)
+    if user is None:
         await update.message.reply_text("User id not found")
         return
+    user.permission_to_print = False
+    username = user.name
+    await context.bot.send_message(user.id, "You no longer have permission to print...")
     store_data()
     await update.message.reply_text("Permission to print of {} set to False".format(username))
 
+async def ratelimit_command(update: Update, context: CallbackContext) -> None:
+    """Set the rate limit of a user"""
+    if not user_is_admin(update.message.from_user.id):
+        await update.message.reply_text("You are not allowed to use this command")
+        return
+    usage = "Usage: /ratelimit id messages minutes, or /ratelimit id default"
+    arguments = update.message.text.split()
+    if len(arguments) == 3 and arguments[2].lower() == 'default':
+        rate_limit = None
+    elif len(arguments) == 4:
+        try:
+            rate_limit = [int(arguments[2]), float(arguments[3])]
+        except ValueError:
+            await update.message.reply_text(usage)
+            return
+        if not valid_rate_limit(rate_limit):
+            await update.message.reply_text("A user has to be able to send at least 1 message in more than 0 minutes.\n" + usage)
+            return
+    else:
+        await update.message.reply_text(usage)
+        return
+    try:
+        user = users.get(arguments[1])
+    except ValueError:
+        user = None
+    if user is None:
+        await update.message.reply_text("User id not found")
+        return
+    user.rate_limit = rate_limit
+    store_data()
+    messages, minutes = user.rate_limit or CONFIG['user_rate_limit']
+    await update.message.reply_text("{} can now send {} messages per {} minutes".format(user.name, messages, minutes))
+
 async def help_command(update: Update, context: CallbackContext) -> None:
     """Send instructions"""
     await update.message.reply_text(("Everything sent to this bot will be printed on a thermal receipt printer. (Posiflex PP-8000B)\n\n"
         "Currently the following message types are supported:\n"
-        "- Text (when sending emojis their discription is printed, like: [FLUSHED FACE] or [SNOWMAN WITHOUT SNOW]. When the text contains a url, a QR code is printed after the text message which points to the url.)\n"
+        "- Text (accented letters are printed as they are, when sending emojis their discription is printed, like: [FLUSHED FACE] or [SNOWMAN WITHOUT SNOW]. When the text contains a url, a QR code is printed after the text message which points to the url.)\n"
         "- Images (non-animated stickers also work)\n"
         "\n"
         "The bot supports the following commands:\n"
@@ -235,220 +1413,548 @@ async def help_command(update: Update, context: CallbackContext) -> None:
         "  /listusers - Lists all users with their names, id and permission to print\n"
         "  /givepermission [id] - Gives a user permission to print. When no id is given the last registered user gets permission to print\n"
         "  /removepermission [id] - Revoke permission to print for a user. When no id is given the last registered user loses its permission to print.\n"
+        "  /ratelimit id messages minutes - Let a user send this many messages per amount of minutes. Use /ratelimit id default to reset it\n"
         "  /printqueue - Prints all messages in the queue\n"
-        "  /emptyqueue - Sets all received messages to printed\n"))
+        "  /emptyqueue - Sets all received messages to printed\n"
+        "  /queue - Shows the amount of queued messages per user\n"))
 
 async def stats_command(update: Update, context: CallbackContext) -> None:
     """Send stats"""
-    await update.message.reply_text(("Total amount of messages printed: {}\n"
+    reply_text = ("Total amount of messages printed: {}\n"
         "Text messages printed: {}\n"
-        "Images printed: {}\n").format(data['total_prints'], data['text_prints'], data['image_prints']))
+        "Images printed: {}\n").format(data['total_prints'], data['text_prints'], data['image_prints'])
+    # The admin also gets the queue, the printers and where the time goes
+    if user_is_admin(update.message.from_user.id):
+        reply_text += "\nUnprinted messages: {}\nPrint jobs pending: {}\n".format(message_store.count_unprinted(), print_worker.pending())
+        reply_text += "\nPrinter | State | Jobs | Failed | Bytes sent\n"
+        for connection in printers:
+            if connection.paper_out:
+                state = "out of paper"
+            elif connection.connected:
+                state = "connected"
+            else:
+                state = "offline"
+            reply_text += "{} | {} | {} | {} | {}\n".format(connection.devfile, state, *connection.stats())
+        reply_text += "\nStage | Count | Average | 90% below\n"
+        with metrics.lock:
+            for stage, histogram in metrics.stages.items():
+                if histogram.count > 0:
+                    reply_text += "{} | {} | {:.0f} ms | {} s\n".format(stage, histogram.count,
+                        histogram.sum / histogram.count * 1000, histogram.quantile(0.9))
+            if metrics.errors:
+                reply_text += "\nErrors: {}\n".format(", ".join("{} {}".format(error, count) for error, count in sorted(metrics.errors.items())))
+    await update.message.reply_text(reply_text)
 
 async def anonymous_command(update: Update, context: CallbackContext) -> None:
     """Set anonymous status"""
     command_words = update.message.text.split()
+    user = users.get(update.message.from_user.id)
+    if user is None:
+        await update.message.reply_text("Please use the /start command first.")
+        return
     if len(command_words) == 1:
-        for user in data['users']:
-            if user['id'] == update.message.from_user.id:
-                await update.message.reply_text("Anonymous: {}\nYou can enable or disable anonymous messages with /anonymous true/false".format(user['anonymous']))
-                break;
+        await update.message.reply_text("Anonymous: {}\nYou can enable or disable anonymous messages with /anonymous true/false".format(user.anonymous))
     else:
-        for user in data['users']:
-            if user['id'] == update.message.from_user.id:
-                user['anonymous'] = command_words[1].lower() == 'true'
-                await update.message.reply_text("Anonymous setting set to: {}".format(user['anonymous']))
-                break;
+        user.anonymous = command_words[1].lower() == 'true'
+        store_data()
+        await update.message.reply_text("Anonymous setting set to: {}".format(user.anonymous))
+
+# Non-ASCII text is handled per emoji sequence: a pair of regional indicators (a flag), a keycap,
+# or a character with its variation selectors, skin tones and tags, joined to more by zero width joiners
+EMOJI_MODIFIERS = "\ufe0e\ufe0f\U0001F3FB-\U0001F3FF\U000E0020-\U000E007F"
+EMOJI_SEQUENCE_REGEX = re.compile(
+    "[\U0001F1E6-\U0001F1FF]{{2}}"
+    "|[0-9#*]\ufe0f?\u20e3"
+    "|[^\x00-\x7f][{0}]*(?:\u200d[^\x00-\x7f][{0}]*)*".format(EMOJI_MODIFIERS))
+EMOJI_MODIFIER_REGEX = re.compile("[{}]".format(EMOJI_MODIFIERS))
+
+class CodePageEncoder:
+    """Encodes text for the printer, only switching code pages when a character isn't in the current one"""
+
+    def __init__(self, code_pages):
+        self.code_pages = code_pages
+        # Encodings of each character in the code pages that have it, in order of preference
+        self.cache = {}
+
+    def encodings(self, character):
+        encodings = self.cache.get(character)
+        if encodings is None:
+            encodings = {}
+            for number, codec in self.code_pages:
+                try:
+                    encodings[number] = character.encode(codec)
+                except UnicodeEncodeError:
+                    pass
+            self.cache[character] = encodings
+        return encodings
+
+    def can_encode(self, character) -> bool:
+        return len(self.encodings(character)) > 0
+
+    def encode(self, text) -> bytes:
+        """Encode text, characters that aren't in any code page are replaced"""
+        # ASCII is the same in all code pages
+        if text.isascii():
+            return text.encode('ascii')
+        output = bytearray()
+        current = None
+        for character in text:
+            if character < '\x80':
+                output += character.encode('ascii')
+                continue
+            encodings = self.encodings(character)
+            if not encodings:
+                output += replace_character(character).encode('ascii', 'replace')
+            else:
+                if current not in encodings:
+                    # ESC t n, select the first code page which has the character
+                    current = next(iter(encodings))
+                    output += b'\x1bt' + bytes([current])
+                output += encodings[current]
+        return bytes(output)
+
+text_encoder = CodePageEncoder(PRINTER_CODE_PAGES)
+
+def print_text(printer, text) -> None:
+    """Send text in the printer's own code pages"""
+    printer._raw(text_encoder.encode(text))
+
+@functools.lru_cache(maxsize=4096)
+def replace_character(character):
+    """Keep characters the printer can print, otherwise replace them with ASCII or a description"""
+    if text_encoder.can_encode(character):
+        return character
+    from unidecode import unidecode
+    replaced = unidecode(character)
+    if replaced != '':
+        return replaced
+    try:
+        return "[" + unicodedata.name(character) + "]"
+    except ValueError:
+        return "[x]"
+
+@functools.lru_cache(maxsize=4096)
+def replace_sequence(sequence):
+    """Replace an emoji sequence with a single description"""
+    if len(sequence) == 1:
+        return replace_character(sequence)
+    # Flags consist of two regional indicators, which map to the letters of the country code
+    if '\U0001F1E6' <= sequence[0] <= '\U0001F1FF':
+        return "[FLAG {}]".format("".join(chr(ord(character) - 0x1F1E6 + ord('A')) for character in sequence))
+    if sequence.endswith('\u20e3'):
+        return "[KEYCAP {}]".format(sequence[0])
+    # Skin tones and variation selectors don't change the description
+    parts = [EMOJI_MODIFIER_REGEX.sub('', part) for part in sequence.split('\u200d')]
+    if len(parts) == 1:
+        return replace_character(parts[0])
+    return "[" + " + ".join(unicodedata.name(part, "x") for part in parts if part) + "]"
+
+def wrap_text(text) -> str:
+    """Wrap text to the width of the paper, so words aren't broken off by the printer"""
+    return "\n".join(textwrap.fill(line, PRINTER_COLUMNS, break_on_hyphens=False) for line in text.split("\n"))
 
-# Function taken from https://stackoverflow.com/questions/43797500/python-replace-unicode-emojis-with-ascii-characters
 def replace_emojis(input_string):
     """Replace emojis with descriptions about the emojis"""
-    return_string = ""
-    for character in input_string:
-        try:
-            character.encode("ascii")
-            return_string += character
-        except UnicodeEncodeError:
-            replaced = unidecode(str(character))
-            if replaced != '':
-                return_string += replaced
-            else:
-                try:
-                     return_string += "[" + unicodedata.name(character) + "]"
-                except ValueError:
-                     return_string += "[x]"
-    return return_string
+    # Most messages are plain ASCII
+    if input_string.isascii():
+        return input_string
+    # Combine letters and accents, so they're replaced as one character
+    input_string = unicodedata.normalize('NFC', input_string)
+    return EMOJI_SEQUENCE_REGEX.sub(lambda match: replace_sequence(match.group()), input_string)
 
 async def get_text_message(update: Update, context: CallbackContext) -> None:
     """Get and store received text message"""
-    # Check if user exists
-    if not user_exists(update.message.from_user):
-        await update.message.reply_text("Please use the /start command before sending anything.")
-        return
-    # Check if user is spamming
-    if is_spamming(update.message.from_user):
-        await update.message.reply_text("Please wait a few minutes before sending another message.")
-        return
-    # Get name and permission to print
-    name, permission_to_print = user_info(update.message.from_user)
-    if not permission_to_print:
-        await update.message.reply_text("You do not have permission to print anymore.")
+    # Check if user exists, isn't spamming and has permission to print
+    user = await authorize(update, CONFIG['text_cost'])
+    if user is None:
         return
+    name = user.display_name
     # Print message
     logging.info("Message received: {}: {}".format(name, update.message.text))
-    # Store message
+    # Store message, urls are looked up once so printing doesn't have to
+    with metrics.timer('normalize'):
+        text = replace_emojis(update.message.text)
+        wrapped_text = wrap_text(text)
+        urls = find_urls(text)
     message = {
         'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
         'sender': name,
-        'text': replace_emojis(update.message.text),
+        'sender_id': user.id,
+        'text': wrapped_text,
+        'urls': urls,
         'image_path': None,
         'printed': False,
         }
+    # Store message
+    message_store.add(message)
     # Print message
     if printing:
-        if print_text_message(message):
-            # Reply
-            await update.message.reply_text("Printed!")
-        else:
-            await error_printing(update, context, name)
+        await queue_print_job(update, context, name, message)
     else:
         await update.message.reply_text("Message will soon be printed!")
-    # Add message to list
-    messages.append(message)
-    # Save messages to disk
-    with open('messages.json', 'w') as save_file:
-        json.dump(messages, save_file)
     # Start led
     start_blinking()
 
-def print_text_message(message):
-    """Prints a text message"""
-    try:
-        # Open serial interface
-        p.open()
-        # Print text
-        p.text("{} - {}:\n{}\n".format(message['timestamp'], message['sender'], message['text']))
-        #p.text("{} - {}:\n{}\n".format(message['timestamp'], "awv61", message['text'])) # ONLY FOR VIDEO
-        # Get urls in message and print qr codes for the urls
-        urls = re.findall(URL_REGEX, message['text'])
-        for url in urls:
-            p.text("\n{}".format(url))
-            p.qr(url, size=8, center=True)
-        # Cut, reply and update stats
-        p.cut()
-        # Close interface
-        p.close();
-        # Update stats
-        update_stats('text')
-        return True
-    except:
-        return False
+def strip_url_punctuation(candidate) -> str:
+    """Remove trailing punctuation, closing brackets only when they aren't part of the url like in a_(b)"""
+    while candidate:
+        last = candidate[-1]
+        if last in ".,;:!?":
+            candidate = candidate[:-1]
+        elif last in URL_BRACKETS and candidate.count(last) > candidate.count(URL_BRACKETS[last]):
+            candidate = candidate[:-1]
+        else:
+            break
+    return candidate
+
+def find_urls(text):
+    """Return the urls in a text"""
+    urls = []
+    # Most messages have no url at all
+    if '.' not in text and '://' not in text:
+        return urls
+    for candidate in URL_CANDIDATE_REGEX.findall(text):
+        candidate = strip_url_punctuation(candidate.lstrip("([{"))
+        lower = candidate.lower()
+        if lower.startswith(('http://', 'https://')):
+            urls.append(candidate)
+            continue
+        # Skip email addresses
+        if '@' in candidate:
+            continue
+        host = lower.split('/', 1)[0].split(':', 1)[0]
+        labels = host.split('.')
+        if len(labels) >= 2 and labels[-1] in URL_TLDS and all(URL_HOST_LABEL_REGEX.fullmatch(label) for label in labels):
+            urls.append(candidate)
+    return urls
+
+@functools.lru_cache(maxsize=64)
+def render_qr(url) -> bytes:
+    """Render the commands to print a qr code, repeated urls don't have to be rendered again"""
+    from escpos.printer import Dummy
+    printer = Dummy()
+    printer.qr(url, size=8, center=True)
+    return printer.output
+
+def render_text_message(printer, message) -> None:
+    """Send a text message to a printer"""
+    # Print text
+    print_text(printer, "{} - {}:\n{}\n".format(message['timestamp'], message['sender'], message['text']))
+    #printer.text("{} - {}:\n{}\n".format(message['timestamp'], "awv61", message['text'])) # ONLY FOR VIDEO
+    # Print qr codes for the urls in the message, messages of older versions don't have them yet
+    urls = message['urls'] if 'urls' in message else find_urls(message['text'])
+    for url in urls:
+        print_text(printer, "\n{}".format(url))
+        printer._raw(render_qr(url))
+    # Cut
+    printer.cut()
 
 async def get_photo_message(update: Update, context: CallbackContext) -> None:
     """Get and store received image"""
-    # Check if user exists
-    if not user_exists(update.message.from_user):
-        await update.message.reply_text("Please use the /start command before sending anything.")
-        return
-    # Check if user is spamming
-    if is_spamming(update.message.from_user):
-        await update.message.reply_text("Please wait a few minutes before sending another message.")
+    # Animated stickers are turned down before they take anything from the rate limits
+    if update.message.sticker != None and update.message.sticker.is_animated:
+        await update.message.reply_text("Cannot print animated stickers...")
         return
-    # Get name and permission to print
-    name, permission_to_print = user_info(update.message.from_user)
-    if not permission_to_print:
-        await update.message.reply_text("You do not have permission to print anymore.")
+    # Check if user exists, isn't spamming and has permission to print
+    user = await authorize(update, CONFIG['image_cost'])
+    if user is None:
         return
+    name = user.display_name
     logging.info("Image received from {}".format(name))
     # Get image from Telegram
     if update.message.document != None:
-        imageFile = await context.bot.get_file(update.message.document.file_id)
+        attachment = update.message.document
     elif update.message.sticker != None:
-        if (update.message.sticker.is_animated):
-            await update.message.reply_text("Cannot print animated stickers...")
-            return
         # Get sticker
-        imageFile = await context.bot.get_file(update.message.sticker.file_id)
+        attachment = update.message.sticker
     elif update.message.photo != None:
-        imageFile = await context.bot.get_file(update.message.photo[-1].file_id)
-    image = await imageFile.download_to_drive()
-    print(image)
-    # Resize image to correct size (maximum width of 512 pixels)
-    img = Image.open(image)
-    wpercent = (512/float(img.size[0]))
-    hsize = int((float(img.size[1])*float(wpercent)))
-    img = img.resize((512, hsize))
-    img.save(image)
+        attachment = update.message.photo[-1]
+    # Images which were sent before (popular stickers) are already prepared
+    key = attachment.file_unique_id
+    image = image_cache.get(key)
+    if image is None:
+        # Updates are handled concurrently, the same image sent at the same time is only downloaded once
+        download = image_downloads.get(key)
+        if download is None:
+            download = image_downloads[key] = asyncio.ensure_future(download_image(context, attachment, name))
+            download.add_done_callback(lambda download: image_downloads.pop(key, None))
+        image = await download
+    else:
+        logging.info("Image from {} found in cache".format(name))
     # Get caption
     caption = update.message.caption
     # Replace emojis
     if caption != None:
-        caption = replace_emojis(caption),
+        with metrics.timer('normalize'):
+            caption = wrap_text(replace_emojis(caption))
     # Store message
     message = {
         'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
         'sender': name,
+        'sender_id': user.id,
         'text': caption,
         'image_path': str(image),
         'printed': False,
         }
+    # Store message
+    message_store.add(message)
     # Print message
     if printing:
-        if print_photo_message(message):
-            # Reply
-            await update.message.reply_text("Printed!")
-        else:
-            await error_printing(update, context, name)
+        await queue_print_job(update, context, name, message)
     else:
         await update.message.reply_text("Message will soon be printed!")
-    # Add message to list
-    messages.append(message)
-    # Save messages to disk
-    with open('messages.json', 'w') as save_file:
-        json.dump(messages, save_file)
     # Start led
     start_blinking()
 
-def print_photo_message(message):
-    """Prints message with photo"""
-    try:
-        # Open serial interface
-        p.open()
-        # Print text
-        p.text("{} - {}:\n".format(message['timestamp'], message['sender']))
-        #p.text("{} - {}:\n".format(message['timestamp'], "awv61"))
-        # Print image
-        p.image(message['image_path'])
-        # Wait some time before continuing with the rest, the following two lines fixed all my image printing problems
-        time.sleep(1)
-        p.text("\n")
-        # Print caption
-        if message['text'] != None:
-            p.text(message['text'])
-        # Cut and reply
-        p.cut()
-        # Close interface
-        p.close()
-        # Update stats
-        update_stats('image')
-        return True
-    except:
-        return False
+# Images which are being downloaded and prepared, keyed on file_unique_id
+image_downloads = {}
+
+async def download_image(context: CallbackContext, attachment, name):
+    """Download and prepare an image, returns its path in the image cache"""
+    imageFile = await context.bot.get_file(attachment.file_id)
+    # Download into memory and only store the resized image
+    download_start = time.perf_counter()
+    raw_image = await imageFile.download_as_bytearray()
+    download_time = time.perf_counter() - download_start
+    image = image_cache.path(attachment.file_unique_id)
+    timings = await asyncio.get_running_loop().run_in_executor(image_executor, prepare_image, raw_image, image)
+    image_cache.add(attachment.file_unique_id)
+    metrics.observe('download', download_time)
+    for stage in ('decode', 'resize', 'rasterize'):
+        metrics.observe(stage, timings[stage])
+    logging.info("Image from {} ({} bytes): download {:.2f}s, decode {:.2f}s, resize {:.2f}s, rasterize {:.2f}s, save {:.2f}s".format(
+        name, len(raw_image), download_time, timings['decode'], timings['resize'], timings['rasterize'], timings['save']))
+    return image
+
+class ImageCache:
+    """Prepared images keyed on Telegram's file_unique_id, the least recently used are removed when it gets too big"""
+
+    def __init__(self, directory, max_bytes, pinned):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Returns the paths of images which are still needed, like those of unprinted messages
+        self.pinned = pinned
+        self.lock = threading.Lock()
+        # Sizes of the cached images, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        # Restore the order of use from the modification times
+        files = [entry for entry in os.scandir(directory) if entry.name.endswith(RASTER_EXTENSION)]
+        for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+            self.entries[entry.name[:-len(RASTER_EXTENSION)]] = entry.stat().st_size
+            self.size = self.size + entry.stat().st_size
+
+    def path(self, key) -> str:
+        return os.path.join(self.directory, key + RASTER_EXTENSION)
+
+    def get(self, key):
+        """Return the path of a cached image, or None if it isn't cached"""
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        path = self.path(key)
+        # Touch the file so the order of use survives a restart
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.size = self.size - self.entries.pop(key, 0)
+            return None
+        return path
+
+    def add(self, key) -> None:
+        """Register a newly prepared image and remove old images if the cache is too big"""
+        size = os.path.getsize(self.path(key))
+        with self.lock:
+            self.size = self.size - self.entries.pop(key, 0) + size
+            self.entries[key] = size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def remove(self, key) -> None:
+        with self.lock:
+            if key not in self.entries:
+                return
+            self.size = self.size - self.entries.pop(key)
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def remove_unused(self, before) -> None:
+        """Remove images which weren't used since before (a unix timestamp) and aren't needed anymore"""
+        pinned = self.pinned()
+        with self.lock:
+            candidates = [key for key in self.entries if self.path(key) not in pinned]
+        for key in candidates:
+            try:
+                last_used = os.path.getmtime(self.path(key))
+            except FileNotFoundError:
+                last_used = 0
+            if last_used < before:
+                self.remove(key)
+
+    def evict(self) -> None:
+        """Remove the least recently used images until the cache fits again"""
+        pinned = self.pinned()
+        with self.lock:
+            candidates = [key for key in self.entries if self.path(key) not in pinned]
+        for key in candidates:
+            if self.size <= self.max_bytes:
+                break
+            self.remove(key)
+            logging.info("Removed image {} from cache".format(key))
+
+def prepare_image(raw_image, path):
+    """Decode, resize and rasterize an image for printing, returns the time spent on each step"""
+    from PIL import Image
+    from escpos.image import EscposImage
+    timings = {}
+    start = time.perf_counter()
+    img = Image.open(io.BytesIO(raw_image))
+    # JPEGs can be scaled down while decoding, which is a lot faster than decoding the full photo
+    if img.format == 'JPEG':
+        img.draft('L', (IMAGE_WIDTH, int(img.size[1] * IMAGE_WIDTH / img.size[0])))
+    img.load()
+    timings['decode'] = time.perf_counter() - start
+    start = time.perf_counter()
+    # Put transparent images like stickers on a white background
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        img = Image.alpha_composite(Image.new('RGBA', img.size, 'white'), img)
+    # Resize image to correct size (maximum width of 512 pixels), the printer only prints grayscale anyway
+    img = img.convert('L')
+    hsize = int(img.size[1] * IMAGE_WIDTH / img.size[0])
+    img = img.resize((IMAGE_WIDTH, hsize))
+    timings['resize'] = time.perf_counter() - start
+    # Dither to black and white once, so printing only has to send the bytes
+    start = time.perf_counter()
+    raster = EscposImage(img)
+    raster_data = raster.to_raster_format()
+    timings['rasterize'] = time.perf_counter() - start
+    start = time.perf_counter()
+    with open(path, 'wb') as raster_file:
+        raster_file.write(struct.pack('<HH', raster.width_bytes, raster.height))
+        raster_file.write(raster_data)
+    timings['save'] = time.perf_counter() - start
+    return timings
+
+def load_raster(path):
+    """Return width in bytes, height and data of a raster stored by prepare_image"""
+    with open(path, 'rb') as raster_file:
+        width_bytes, height = struct.unpack('<HH', raster_file.read(4))
+        return width_bytes, height, raster_file.read()
+
+def halve_pixels(byte):
+    """Return the 4 pixels a byte of 8 pixels is made of if every pixel is doubled, otherwise None"""
+    half = 0
+    for bit in range(0, 8, 2):
+        pair = (byte >> bit) & 0b11
+        if pair == 0b11:
+            half = half | (1 << (bit // 2))
+        elif pair != 0:
+            return None
+    return half
+
+HALF_PIXELS = [halve_pixels(byte) for byte in range(256)]
+
+def encode_band(rows) -> bytes:
+    """GS v 0 command for a band of rows, in double height or width when that prints the same image"""
+    mode = 0
+    # Double height when every row is printed twice
+    if len(rows) % 2 == 0 and all(rows[i] == rows[i + 1] for i in range(0, len(rows), 2)):
+        rows = rows[::2]
+        mode = mode | 2
+    # Double width when every pixel is printed twice
+    if len(rows[0]) % 2 == 0 and all(HALF_PIXELS[byte] is not None for row in rows for byte in row):
+        rows = [bytes((HALF_PIXELS[row[i]] << 4) | HALF_PIXELS[row[i + 1]] for i in range(0, len(row), 2)) for row in rows]
+        mode = mode | 1
+    return b'\x1dv0' + bytes([mode]) + struct.pack('<HH', len(rows[0]), len(rows)) + b''.join(rows)
+
+def encode_raster(width_bytes, height, raster_data) -> bytes:
+    """Encode a raster into as few ESC/POS bytes as possible"""
+    rows = [raster_data[row * width_bytes:(row + 1) * width_bytes] for row in range(height)]
+    blank = [not any(row) for row in rows]
+    # Leave out white rows at the top and bottom
+    top = 0
+    while top < height and blank[top]:
+        top = top + 1
+    if top == height:
+        return b''
+    bottom = height
+    while blank[bottom - 1]:
+        bottom = bottom - 1
+    # Leave out white columns, as much on both sides so the image stays centered
+    trim = width_bytes // 2
+    for row in rows[top:bottom]:
+        stripped = row.lstrip(b'\x00')
+        if stripped:
+            trim = min(trim, len(row) - len(stripped), len(stripped) - len(stripped.rstrip(b'\x00')))
+    if trim > 0:
+        rows = [row[trim:width_bytes - trim] for row in rows]
+    commands = []
+    band = []
+    row = top
+    while row < bottom:
+        # White rows are sent one byte wide instead of the whole width
+        run = 0
+        while blank[row + run]:
+            run = run + 1
+        if run >= RASTER_MIN_BLANK:
+            if band:
+                commands.append(encode_band(band))
+                band = []
+            for start in range(0, run, RASTER_BAND_HEIGHT):
+                commands.append(encode_band([b'\x00'] * min(RASTER_BAND_HEIGHT, run - start)))
+            row = row + run
+            continue
+        band.append(rows[row])
+        # Bands are printed while the next ones are still being sent
+        if len(band) == RASTER_BAND_HEIGHT:
+            commands.append(encode_band(band))
+            band = []
+        row = row + 1
+    if band:
+        commands.append(encode_band(band))
+    return b''.join(commands)
+
+@functools.lru_cache(maxsize=16)
+def encode_image(path) -> bytes:
+    """Encode a stored raster, recently printed images don't have to be encoded again"""
+    width_bytes, height, raster_data = load_raster(path)
+    commands = encode_raster(width_bytes, height, raster_data)
+    logging.info("Image {}: {} bytes of raster, {} bytes sent".format(path, len(raster_data), len(commands)))
+    return commands
+
+def print_image(printer, path) -> None:
+    """Print a rasterized image, or let escpos convert images stored by older versions"""
+    if path.endswith(RASTER_EXTENSION):
+        printer._raw(encode_image(path))
+    else:
+        printer.image(path)
+
+def render_photo_message(printer, message) -> None:
+    """Send a message with photo to a printer"""
+    # Print text
+    print_text(printer, "{} - {}:\n".format(message['timestamp'], message['sender']))
+    #printer.text("{} - {}:\n".format(message['timestamp'], "awv61"))
+    # Print image
+    print_image(printer, message['image_path'])
+    printer.text("\n")
+    # Print caption
+    if message['text'] != None:
+        print_text(printer, message['text'])
+    # Cut
+    printer.cut()
 
 async def get_unsupported_message(update: Update, context: CallbackContext) -> None:
     """ Reply that type is unsupported"""
-    # Check if user exists
-    if not user_exists(update.message.from_user):
-        await update.message.reply_text("Please use the /start command before sending anything.")
-        return
-    # Check if user is spamming
-    if is_spamming(update.message.from_user):
-        await update.message.reply_text("Please wait a few minutes before sending another message.")
-        return
-    # Get name and permission to print
-    name, permission_to_print = user_info(update.message.from_user)
-    if not permission_to_print:
-        await update.message.reply_text("You do not have permission to print anymore.")
+    # Check if user exists, isn't spamming and has permission to print
+    user = await authorize(update, 0)
+    if user is None:
         return
+    name = user.display_name
     # Log
     logging.info("Unsupported message received from {}".format(name))
     # Reply
@@ -459,19 +1965,125 @@ async def print_unprinted_messages_command(update: Update, context: CallbackCont
     if not user_is_admin(update.message.from_user.id):
         await update.message.reply_text("You are not allowed to use this command")
         return
-    print_unprinted_messages()
+    job = print_worker.request_drain()
+    context.application.create_task(reply_when_queue_printed(update, job))
+
+async def reply_when_queue_printed(update: Update, job: asyncio.Future) -> None:
+    """Wait for the queue to be printed and notify the admin"""
+    try:
+        await job
+    except Exception:
+        await update.message.reply_text("Failed to print the queue :(")
+        return
     await update.message.reply_text("All unprinted messages printed.")
 
-def print_unprinted_messages():
-    logging.info("Printing all unprinted messages")
-    # Loop over messages
-    for message in messages:
-        if message['printed'] == False:
-            if message['image_path'] == None:
-                print_text_message(message)
+def print_message(connection, message):
+    """Print a single message"""
+    print_batch(connection, [message])
+    return True
+
+def render_message(message) -> bytes:
+    """Render a message into the bytes that are sent to the printer"""
+    from escpos.printer import Dummy
+    printer = Dummy()
+    if message['image_path'] == None:
+        render_text_message(printer, message)
+    else:
+        render_photo_message(printer, message)
+    return printer.output
+
+@functools.lru_cache(maxsize=None)
+def cut_command() -> bytes:
+    """Bytes of the feed and cut at the end of every message"""
+    from escpos.printer import Dummy
+    printer = Dummy()
+    printer.cut()
+    return printer.output
+
+# Ids of the messages which are being printed, so a message which is queued twice is printed once
+printing_ids = set()
+printing_lock = threading.Lock()
+
+def claim_messages(batch):
+    """Return the messages of a batch which still have to be printed, other printers skip them from now on"""
+    with printing_lock:
+        claimed = [message for message in batch if message['id'] not in printing_ids and not message_store.is_printed(message)]
+        printing_ids.update(message['id'] for message in claimed)
+    return claimed
+
+def release_messages(batch) -> None:
+    with printing_lock:
+        printing_ids.difference_update(message['id'] for message in batch)
+
+def print_batch(connection, batch) -> None:
+    """Send messages to a printer as one stream, every message is marked as printed as soon as it's sent"""
+    batch = claim_messages(batch)
+    try:
+        send_batch(connection, batch)
+    finally:
+        release_messages(batch)
+
+def send_batch(connection, batch) -> None:
+    # Render everything before sending, so the printer never waits on rendering
+    stream = bytearray()
+    cuts = []
+    ends = []
+    for message in batch:
+        with metrics.timer('render'):
+            stream += render_message(message)
+        # The cut is sent on its own, so the time the printer takes to get to it can be measured
+        cuts.append(len(stream) - len(cut_command()) if stream.endswith(cut_command()) else len(stream))
+        ends.append(len(stream))
+    done = 0
+
+    def write(printer):
+        nonlocal done
+        # After a failed attempt, continue with the first message which wasn't finished
+        position = ends[done - 1] if done > 0 else 0
+        while done < len(batch):
+            if position < cuts[done]:
+                end = min(position + DRAIN_CHUNK_SIZE, cuts[done])
+                connection.send(stream[position:end])
             else:
-                print_photo_message(message)
-                time.sleep(1)
+                end = ends[done]
+                with metrics.timer('cut'):
+                    connection.send(stream[position:end])
+            position = end
+            if position == ends[done]:
+                if batch[done]['image_path'] != None:
+                    # Let the printer catch up with the image before sending more
+                    connection.pace(ends[done] - (ends[done - 1] if done > 0 else 0))
+                finish_message(batch[done])
+                done = done + 1
+
+    connection.run(write)
+
+def finish_message(message) -> None:
+    """Checkpoint a message which was sent to the printer"""
+    message_store.mark_printed(message)
+    # This runs on the thread of a printer, the stats belong to the event loop
+    if message['image_path'] == None:
+        print_worker.loop.call_soon_threadsafe(update_stats, 'text')
+    else:
+        print_worker.loop.call_soon_threadsafe(update_stats, 'image')
+
+async def queue_command(update: Update, context: CallbackContext) -> None:
+    """Send the amount of unprinted messages per user"""
+    if not user_is_admin(update.message.from_user.id):
+        await update.message.reply_text("You are not allowed to use this command")
+        return
+    unprinted = Counter(message_sender(message) for message in message_store.unprinted())
+    if not unprinted:
+        await update.message.reply_text("The queue is empty")
+        return
+    waiting = print_worker.scheduler.depths()
+    lines = []
+    for sender, count in unprinted.most_common():
+        # Messages of older versions only have the name of the sender
+        user = users.get(sender) if isinstance(sender, int) else None
+        name = user.name if user is not None else sender
+        lines.append("{}: {} unprinted, {} waiting for the printer".format(name, count, waiting.get(sender, 0)))
+    await update.message.reply_text("\n".join(lines))
 
 async def set_all_printed_command(update: Update, context: CallbackContext):
     """Set all messages to printed"""
@@ -484,36 +2096,66 @@ async def set_all_printed_command(update: Update, context: CallbackContext):
 
 def set_all_printed():
     logging.info("Clear unprinted messages")
-    # Loop over messages
-    for message in messages:
-        message['printed'] = True
-    # Save messages to disk
-    with open('messages.json', 'w') as save_file:
-        json.dump(messages, save_file)
+    message_store.mark_all_printed()
     # Stop blinking
     stop_blinking()
 
-def main():
-    """Starting point"""
-    # Printer object
-    global p
-    p = Serial(devfile='/dev/ttyUSB1',
-               baudrate=115200,
-               bytesize=8,
-               parity='N',
-               stopbits=1,
-               timeout=1.00,
-               dsrdtr=True)
-
-    # Printer settings
-    p.set(align='center')
-    # Print started message
-    p.text("Bragi started!")
-    p.cut()
-    # Close connection
-    p.close()
-    # Load saves dict
-    global data
+def render_started_message(printer) -> None:
+    printer.text("Bragi started!")
+    printer.cut()
+
+class BatchedBot(ExtBot):
+    """Bot which asks Telegram for at most polling_batch_size updates at a time"""
+
+    async def get_updates(self, offset=None, limit=None, *args, **kwargs):
+        if limit is None:
+            limit = CONFIG['polling_batch_size']
+        return await super().get_updates(offset, limit, *args, **kwargs)
+
+def run_webhook(application: Application) -> None:
+    """Receive updates on the webhook server, falls back to polling when it isn't installed"""
+    try:
+        import tornado
+    except ImportError:
+        logging.error("Webhook mode needs python-telegram-bot[webhooks], polling for updates instead")
+        run_polling(application)
+        return
+    logging.info("Receiving updates on {}".format(CONFIG['webhook_url']))
+    application.run_webhook(listen=CONFIG['webhook_listen'],
+                            port=CONFIG['webhook_port'],
+                            url_path=CONFIG['webhook_path'],
+                            webhook_url=CONFIG['webhook_url'],
+                            secret_token=CONFIG['webhook_secret'],
+                            # Telegram doesn't send more updates at once than are handled at once
+                            max_connections=CONFIG['concurrent_updates'])
+
+def run_polling(application: Application) -> None:
+    logging.info("Polling for updates")
+    application.run_polling(timeout=CONFIG['polling_timeout'], poll_interval=CONFIG['polling_interval'])
+
+def log_startup_phase(phase, start) -> float:
+    """Log how long a phase of starting up took, returns the start of the next phase"""
+    now = time.perf_counter()
+    logging.info("Startup: {} took {:.2f}s".format(phase, now - start))
+    return now
+
+def load_config() -> None:
+    """Override the default settings with the ones in config.json"""
+    default_rate_limit = CONFIG['user_rate_limit']
+    try:
+        with open("config.json") as config_file:
+            CONFIG.update(json.load(config_file))
+    except FileNotFoundError:
+        logging.info("No config.json file found. Using default settings.")
+    # An unusable rate limit would make every message fail
+    if not valid_rate_limit(CONFIG['user_rate_limit']):
+        logging.warning("Ignoring invalid user_rate_limit {}, using {}".format(CONFIG['user_rate_limit'], default_rate_limit))
+        CONFIG['user_rate_limit'] = default_rate_limit
+
+def load_saves() -> bool:
+    """Load saves.json with the users and rate limits, returns False if the bot can't start"""
+    global data, saves, users, rate_limiter
+    saves = SaveFile('saves.json', lambda: dict(data, users=users.to_list(), rate_limits=rate_limiter.snapshot()))
     try:
         with open("saves.json") as save_file:
             data = json.load(save_file)
@@ -533,18 +2175,64 @@ def main():
                 admin_id = admin_file.read().strip()
         except FileNotFoundError:
             logging.error("No admin_id file found. Add your user id in a file called admin_id.txt in the same directory as the bot.")
-            return
+            return False
         data['admin_id'] = int(admin_id)
-        with open('saves.json', 'w') as save_file:
-            json.dump(data, save_file)
-    # Load message list
-    global messages
-    try:
-        with open("messages.json") as save_file:
-            messages = json.load(save_file)
-    except FileNotFoundError:
-        logging.info("messages.json file not found. Creating empty list.")
-        messages = []
+        saves.write(json.dumps(data))
+    # Index users on their id, they're written back to saves.json by the save file
+    users = UserRegistry(data.pop('users'))
+    # Restore rate limits from before the last restart
+    rate_limiter = RateLimiter()
+    rate_limiter.restore(data.pop('rate_limits', None))
+    return True
+
+def open_storage() -> None:
+    """Open the message store and the image cache"""
+    global message_store, image_cache
+    phase_start = time.perf_counter()
+    # Directories for received images and archived messages
+    os.makedirs(IMAGE_DIRECTORY, exist_ok=True)
+    os.makedirs(ARCHIVE_DIRECTORY, exist_ok=True)
+    # Open message store, messages.json files of older versions are imported once
+    message_store = MessageStore("messages.db")
+    message_store.import_json("messages.json")
+    phase_start = log_startup_phase("opening message store", phase_start)
+    # Cache of prepared images, images of unprinted messages are never removed
+    image_cache = ImageCache(IMAGE_DIRECTORY, CONFIG['image_cache_megabytes'] * 1024 * 1024, message_store.unprinted_image_paths)
+    log_startup_phase("scanning image cache", phase_start)
+
+def setup_workers(connections) -> None:
+    """Create the print worker for the printers and hand the GPIO events to the event loop"""
+    global printers, print_worker, gpio_bridge
+    printers = connections
+    # Worker which does all the printing
+    print_worker = PrintWorker(printers)
+    # Set callback for button press, they're handled on the event loop
+    gpio_bridge = GpioBridge(gpio)
+    gpio_bridge.add_event(PRINTQUEUE_PIN, gpio.FALLING, printqueue_button_callback)
+    gpio_bridge.add_event(CLEARQUEUE_PIN, gpio.FALLING, clearqueue_button_callback)
+    gpio_bridge.add_event(PRINT_TOGGLE_PIN, gpio.BOTH, print_toggle_callback, settle=True)
+
+def main():
+    """Starting point"""
+    phase_start = log_startup_phase("imports", STARTED_AT)
+    # Buttons and LED
+    setup_gpio()
+    # Load settings
+    load_config()
+    # Printer connections, kept open while the bot runs. They're opened in the background once updates are handled
+    if CONFIG['printer_devices']:
+        connections = [PrinterConnection(devfile) for devfile in CONFIG['printer_devices']]
+    else:
+        # The device is looked up again on every connect, the printer might not be plugged in yet
+        connections = [PrinterConnection(PRINTER_DEVICES[0], candidates=PRINTER_DEVICES)]
+    phase_start = log_startup_phase("GPIO, config and printer setup", phase_start)
+    # Load saves dict
+    if not load_saves():
+        return
+    phase_start = log_startup_phase("loading saves", phase_start)
+    # Message store and cache of prepared images
+    open_storage()
+    phase_start = time.perf_counter()
 
     # Start the bot
     TOKEN = None
@@ -555,10 +2243,15 @@ def main():
         logging.error("No token file found. Add your token in a file called token.txt in the same directory as the bot.")
         return
     
-    # Set callback for button press
-    GPIO.add_event_detect(4,GPIO.FALLING,callback=printqueue_button_callback)
-    GPIO.add_event_detect(24,GPIO.FALLING,callback=clearqueue_button_callback)
-    GPIO.add_event_detect(25,GPIO.BOTH,callback=print_toggle_callback)
+    # Worker which does all the printing and the buttons
+    setup_workers(connections)
+
+    # Metrics, the gauges are read when they're requested
+    metrics.gauge('bragi_unprinted_messages', "Messages which haven't been printed yet", message_store.count_unprinted)
+    metrics.gauge('bragi_print_jobs_pending', "Jobs waiting for or being handled by the printer", print_worker.pending)
+    metrics.gauge('bragi_printers_connected', "Printers with an open connection", lambda: sum(connection.connected for connection in printers))
+    metrics.gauge('bragi_printers_available', "Printers which can take jobs", lambda: sum(connection.available() for connection in printers))
+    metrics_server = start_metrics_server()
 
     # Printing toggle state
     if printing:
@@ -566,8 +2259,16 @@ def main():
     else:
         logging.info("Immediate printing disabled")
 
-    # Create application
-    application = Application.builder().token(TOKEN).build()
+    # Create application, the bot is built here so it can limit the updates per request
+    bot = BatchedBot(TOKEN,
+                     request=HTTPXRequest(connection_pool_size=256),
+                     get_updates_request=HTTPXRequest())
+    application = (Application.builder()
+        .bot(bot)
+        .concurrent_updates(CONFIG['concurrent_updates'])
+        .post_init(start_workers)
+        .post_shutdown(stop_workers)
+        .build())
 
     # Handle commands
     application.add_handler(CommandHandler("start", start))
@@ -577,8 +2278,10 @@ def main():
     application.add_handler(CommandHandler("givepermission", givepermission_command))
     application.add_handler(CommandHandler("removepermission", removepermission_command))
     application.add_handler(CommandHandler("anonymous", anonymous_command))
+    application.add_handler(CommandHandler("ratelimit", ratelimit_command))
     application.add_handler(CommandHandler("printqueue", print_unprinted_messages_command))
     application.add_handler(CommandHandler("emptyqueue", set_all_printed_command))
+    application.add_handler(CommandHandler("queue", queue_command))
     # Handle text messages and photos
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, get_text_message))
     application.add_handler(MessageHandler(filters.PHOTO, get_photo_message))
@@ -586,12 +2289,26 @@ def main():
     application.add_handler(MessageHandler(filters.Sticker.ALL, get_photo_message))
     # Send reply when sending unupported message
     application.add_handler(MessageHandler(filters.ALL & ~filters.TEXT & ~filters.COMMAND & ~filters.PHOTO & ~filters.Document.IMAGE & ~filters.Sticker.ALL, get_unsupported_message))
+    log_startup_phase("creating application", phase_start)
+
+    # Start receiving updates
+    if CONFIG['webhook_url']:
+        run_webhook(application)
+    else:
+        run_polling(application)
 
-    # Start polling
-    application.run_polling()
+    # Write remaining changes
+    saves.flush()
+    # Close connections
+    for connection in printers:
+        connection.disconnect()
+    if metrics_server is not None:
+        metrics_server.shutdown()
 
     # Cleanup gpio
-    GPIO.cleanup()
+    gpio.cleanup()
+    # Close message store
+    message_store.close()
 
 if __name__ == '__main__':
     main()